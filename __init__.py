@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
 
+from . import controllers
 from . import models
\ No newline at end of file
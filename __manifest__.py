@@ -24,13 +24,15 @@
     
     # always loaded
     'data': [
-        'data/ir_sequence.xml',
         'data/cron.xml',
+        'data/retention.xml',
         'security/ir.model.access.csv',
         'security/firebase_security.xml',
         'views/firebase_bridge.xml',
         'views/firebase_message.xml',
         'views/firebase_session.xml',
+        'views/firebase_projection.xml',
+        'views/firebase_retention.xml',
         'views/menu.xml',
     ],
 
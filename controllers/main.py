@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import hmac
+
+from odoo import http
+from odoo.http import request
+from odoo.tools import config
+
+
+class FirebaseMetrics(http.Controller):
+
+    @http.route('/firebase/metrics', type='http', auth='public', methods=['GET'], csrf=False)
+    def metrics(self, token=None, **kwargs):
+        ''' Bridge metrics in Prometheus text format. Metrics live in the
+            memory of the process running the bridges, so in multi-worker
+            setups scrape the server that hosts them.
+            Allowed with the firebase_metrics_token config option as bearer
+            token (or token parameter), or to Firebase operators'''
+        expected = config.get('firebase_metrics_token')
+        header = request.httprequest.headers.get('Authorization', '')
+        given = header[7:] if header.startswith('Bearer ') else token
+        allowed = (expected and given and hmac.compare_digest(str(expected), str(given))) \
+            or request.env.user.has_group('firebase_bridge.firebase_operator')
+        if not allowed:
+            return request.make_response('Forbidden\n', status=403, headers=[('Content-Type', 'text/plain')])
+        bridges = request.env['firebase.bridge'].sudo().search([])
+        return request.make_response(bridges.render_metrics(), headers=[
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+        ])
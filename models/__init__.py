@@ -1,3 +1,3 @@
 # -*- coding: utf-8 -*-
 
-from . import firebase_bridge,firebase_session, firebase_mixin, firebase_message
+from . import firebase_bridge,firebase_session, firebase_mixin, firebase_message, firebase_message_recipient, firebase_projection, firebase_push_state, firebase_retention, firebase_benchmark
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+from .firebase_encoder import dumps
+from .firebase_fake import fake_fcm
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, q):
+    ''' Nearest-rank q percentile of values (0 < q <= 100)'''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(round(q / 100.0 * len(values))) - 1))]
+
+
+class Recorder(object):
+    ''' Fake FCM listener recording when outbound messages are sent.
+        key(device, data) returns the identity of the expected messages,
+        None for the others. The first sending of each one is kept'''
+
+    def __init__(self, key):
+        self.key = key
+        self.seen = {}  # key -> time.monotonic()
+        self._cond = threading.Condition()
+
+    def __call__(self, device, data, options, now):
+        key = self.key(device, data)
+        if key is None:
+            return
+        with self._cond:
+            self.seen.setdefault(key, now)
+            self._cond.notify_all()
+
+    def wait(self, count, timeout):
+        ''' Waits until count messages were seen, or timeout seconds'''
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while len(self.seen) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return len(self.seen)
+
+
+def _data(data):
+    try:
+        return json.loads(data.get('data') or '{}')
+    except (TypeError, ValueError):
+        return {}
+
+
+class FirebaseBenchmark(models.AbstractModel):
+    ''' Load tests of the bridge against the in-process fake FCM endpoint,
+        through the real message loop, dispatcher and RPC code paths.
+        Runs from odoo shell, committing as it goes:
+            env['firebase.benchmark'].run(size=1000)
+        Every scenario reports throughput and p50/p99/max latencies'''
+    _name = 'firebase.benchmark'
+    _description = 'Firebase Bridge benchmarks'
+
+    SCENARIOS = ('create_to_send', 'logins', 'rpc', 'batch', 'fanout', 'pings')
+
+    @api.model
+    def run(self, scenarios=None, size=1000, pool_size=1, timeout=120, ack_delay=0.0,
+            nack_ratio=0.0, cleanup=True, **bridge_values):
+        ''' Runs the scenarios on a temporary fake bridge.
+            ack_delay and nack_ratio tune the fake FCM, bridge_values the
+            bridge settings (e.g. rpc_workers, message_batch).
+            Returns {scenario: report}'''
+        fake_fcm.reset()
+        fake_fcm.ack_delay = ack_delay
+        fake_fcm.nack_ratio = nack_ratio
+        bridge = self._setup(pool_size, **bridge_values)
+        results = {}
+        try:
+            for name in scenarios or self.SCENARIOS:
+                results[name] = getattr(self, '_bench_%s' % name)(bridge, size, timeout)
+                logger.info('Firebase benchmark %s: %s', name, self._format(results[name]))
+        finally:
+            fake_fcm.reset()
+            self._teardown(bridge, cleanup)
+        return results
+
+    def _setup(self, pool_size, **values):
+        bridge = self.env['firebase.bridge'].create(dict({
+            'name': 'Benchmark %s' % uuid.uuid4().hex[:8],
+            'transport': 'fake',
+            'server_id': 'benchmark',
+            'pool_size': pool_size,
+        }, **values))
+        self.env.cr.commit()
+        bridge.connect()
+        self.env.cr.commit()
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            conn = bridge.get_connection()
+            if conn and conn.healthy_count() == pool_size:
+                return bridge
+            time.sleep(0.05)
+        raise TimeoutError('Benchmark bridge did not connect')
+
+    def _teardown(self, bridge, cleanup):
+        bridge.disconnect()
+        deadline = time.monotonic() + 30
+        while bridge.get_connection() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if cleanup:
+            self.env['firebase.message'].search([('bridge_id', '=', bridge.id)]).unlink()
+            sessions = self.env['firebase.session'].with_context(active_test=False).search([('bridge_id', '=', bridge.id)])
+            partners = sessions.partner_id.filtered(lambda p: (p.name or '').startswith('Firebase benchmark'))
+            sessions.unlink()
+            partners.unlink()
+            bridge.unlink()
+        self.env.cr.commit()
+
+    def _sessions(self, bridge, count, prefix, partners=None, idle=0):
+        ''' Creates count live sessions of the current user, spread over
+            partners if given, last seen idle seconds ago'''
+        last = fields.Datetime.now() - timedelta(seconds=idle)
+        sessions = self.env['firebase.session'].create([{
+            'bridge_id': bridge.id,
+            'device': '%s-%s-%s' % (prefix, bridge.id, i),
+            'user_id': self.env.uid,
+            'partner_id': partners[i % len(partners)].id if partners else self.env.user.partner_id.id,
+            'key': uuid.uuid4().hex[:8],
+            'last': last,
+        } for i in range(count)])
+        self.env.cr.commit()
+        return sessions
+
+    def _report(self, count, seen, starts, elapsed):
+        ''' starts: key -> start time, seen: key -> sending time'''
+        latencies = [seen[k] - starts[k] for k in seen if k in starts]
+        return {
+            'expected': count,
+            'done': len(seen),
+            'seconds': elapsed,
+            'throughput': len(seen) / elapsed if elapsed else None,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies) if latencies else None,
+        }
+
+    def _format(self, report):
+        def ms(value):
+            return '-' if value is None else '%.1fms' % (value * 1000)
+        return '%s/%s in %.2fs (%.0f/s), p50 %s, p99 %s, max %s' % (
+            report['done'], report['expected'], report['seconds'], report['throughput'] or 0,
+            ms(report['p50']), ms(report['p99']), ms(report['max']))
+
+    def _measure(self, key, count, timeout, start):
+        ''' Runs start(), which returns {key: start time}, and waits for
+            the count messages identified by key to be sent'''
+        recorder = Recorder(key)
+        fake_fcm.listeners.append(recorder)
+        try:
+            begin = time.monotonic()
+            starts = start()
+            recorder.wait(count, timeout)
+            elapsed = max(recorder.seen.values(), default=begin) - begin
+        finally:
+            fake_fcm.listeners.remove(recorder)
+        return self._report(count, dict(recorder.seen), starts, elapsed)
+
+    def _bench_create_to_send(self, bridge, size, timeout, poll_interval=5):
+        ''' Latency from the commit of a firebase.message to its hand-off to
+            FCM (LISTEN/NOTIFY wake-up and message loop), one message per
+            transaction, then a burst of size messages in one transaction.
+            The 'polling' report is the baseline: single messages again, the
+            loop ignoring wake-ups and running every poll_interval seconds as
+            it did before LISTEN/NOTIFY'''
+        def key(device, data):
+            return _data(data).get('bench') if data.get('type') == 'bench' else None
+
+        def single(offset=0):
+            starts = {}
+            for i in range(offset, offset + min(size, 100)):
+                bridge.create_message({'bridge_id': bridge.id, 'device': 'bench-device', 'type': 'bench', 'data': dumps({'bench': i})})
+                starts[i] = time.monotonic()
+                self.env.cr.commit()
+            return starts
+        report = self._measure(key, min(size, 100), timeout, single)
+
+        def burst():
+            bridge.create_messages([{'bridge_id': bridge.id, 'device': 'bench-device', 'type': 'bench', 'data': dumps({'bench': i})}
+                                    for i in range(1000, 1000 + size)])
+            self.env.cr.commit()
+            now = time.monotonic()
+            return {i: now for i in range(1000, 1000 + size)}
+        report['burst'] = self._measure(key, size, timeout, burst)
+
+        conn = bridge.get_connection()
+        conn.polling = poll_interval
+        try:
+            report['polling'] = self._measure(key, min(size, 100), timeout, lambda: single(-100))
+        finally:
+            conn.polling = 0
+        return report
+
+    def _bench_logins(self, bridge, size, timeout):
+        ''' Session key logins answered with login-ack'''
+        sessions = self._sessions(bridge, size, 'bench-login')
+
+        def key(device, data):
+            return device if data.get('type') == 'login-ack' else None
+
+        def start():
+            starts = {}
+            for session in sessions:
+                starts[session.device] = time.monotonic()
+                fake_fcm.inject(session.device, {'type': 'login', 'key': session.key})
+            return starts
+        return self._measure(key, size, timeout, start)
+
+    def _bench_rpc(self, bridge, size, timeout, devices=50):
+        ''' Correlated search_read RPC bursts from several devices, through
+            the dispatcher and worker pool. Every request has its own offset,
+            so none is answered from the read cache'''
+        sessions = self._sessions(bridge, min(devices, size), 'bench-rpc')
+
+        def key(device, data):
+            return _data(data).get('id') if data.get('type') == 'objects' else None
+
+        def start():
+            starts = {}
+            for i in range(size):
+                session = sessions[i % len(sessions)]
+                correlation_id = 'bench-%s' % i
+                starts[correlation_id] = time.monotonic()
+                fake_fcm.inject(session.device, {
+                    'type': 'rpc',
+                    'key': session.key,
+                    'id': correlation_id,
+                    'model': 'res.partner',
+                    'method': 'search_read',
+                    'args': '[[]]',
+                    'kwargs': json.dumps({'fields': ['name'], 'limit': 5, 'offset': i}),
+                })
+            return starts
+        return self._measure(key, size, timeout, start)
+
+    def _bench_batch(self, bridge, size, timeout, devices=50, calls=10):
+        ''' Batch messages of several search_read calls, answered with one
+            correlated response. Offsets differ across calls and requests, 
+            so none is answered from the read cache'''
+        sessions = self._sessions(bridge, min(devices, size), 'bench-batch')
+
+        def batch(n):
+            return json.dumps([{
+                'id': i,
+                'model': 'res.partner',
+                'method': 'search_read',
+                'args': [[]],
+                'kwargs': {'fields': ['name'], 'limit': 1, 'offset': n * calls + i},
+            } for i in range(calls)])
+
+        def key(device, data):
+            return _data(data).get('id') if data.get('type') == 'batch' else None
+
+        def start():
+            starts = {}
+            for i in range(size):
+                session = sessions[i % len(sessions)]
+                correlation_id = 'bench-batch-%s' % i
+                starts[correlation_id] = time.monotonic()
+                fake_fcm.inject(session.device, {'type': 'batch', 'key': session.key, 'id': correlation_id, 'calls': batch(i)})
+            return starts
+        return self._measure(key, size, timeout, start)
+
+    def _bench_fanout(self, bridge, size, timeout, partners=10):
+        ''' send_to_partners to partners sharing size sessions: one stored
+            message expanded into per-device recipients'''
+        partners = self.env['res.partner'].create([{'name': 'Firebase benchmark %s' % i} for i in range(partners)])
+        sessions = self._sessions(bridge, size, 'bench-fanout', partners=partners)
+
+        def key(device, data):
+            return device if data.get('type') == 'bench-fanout' else None
+
+        def start():
+            bridge.send_to_partners(partners.ids, 'res.partner', {'bench': True}, msg_type='bench-fanout')
+            self.env.cr.commit()
+            now = time.monotonic()
+            return {s.device: now for s in sessions}
+        return self._measure(key, size, timeout, start)
+
+    def _bench_pings(self, bridge, size, timeout):
+        ''' Ping storm: size idle sessions due for a ping at once'''
+        sessions = self._sessions(bridge, size, 'bench-ping', idle=bridge.session_timeout * 3 / 4)
+        # Already pinged once: first pings are spread at random
+        sessions.write({'next_ping': fields.Datetime.now()})
+        self.env.cr.commit()
+        devices = set(sessions.mapped('device'))
+
+        def key(device, data):
+            return device if data.get('type') == 'ping' and device in devices else None
+
+        def start():
+            now = time.monotonic()
+            # ping_batch sessions per round, as the bridge heartbeat does
+            for _round in range(-(-size // (bridge.ping_batch or 500))):
+                bridge.ping_sessions()
+                self.env.cr.commit()
+            return {device: now for device in devices}
+        return self._measure(key, size, timeout, start)
@@ -3,28 +3,75 @@ import asyncio
 import inspect
 import json
 import logging
-import threading
+import random
+import time
 import uuid
+from datetime import timedelta
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from odoo.exceptions import AccessDenied
 from odoo import _, api, models, fields
-from odoo.tools import date_utils
+from odoo.osv import expression
 from xmppgcm import GCM, XMPPEvent
 
+from .firebase_encoder import MAX_PAYLOAD, compress, dumps, encode_chunks, encode_error
+from .firebase_fake import FakeGCM
+from .firebase_message import INVALID_TOKEN_ERRORS, RETRY_ERRORS
+from .firebase_metrics import get_metrics, render
+from .firebase_runner import POLL_TIMEOUT, KeyedDispatcher, PoolMember, SessionCache, TTLCache, runner
+
 logger = logging.getLogger(__name__)
 
+# Payload of the pings sent to idle devices
+PING = {'type': 'ping', 'model': None, 'data': '{}'}
+# FCM accepts up to 1000 simultaneous XMPP connections per sender ID
+MAX_POOL_SIZE = 1000
+# Reconnection delays: RECONNECT_BASE * 2^attempts seconds, capped to
+# RECONNECT_MAX, with jitter so the pool does not reconnect in bursts
+RECONNECT_BASE = 1
+RECONNECT_MAX = 300
+# Seconds a connection attempt may take before trying again
+CONNECT_TIMEOUT = 30
+# RPC methods run without committing, whose results may be cached
+READ_METHODS = ('search_read', 'read', 'name_search')
+# XMPP client classes by transport. Called as factory(jid, server_key)
+CLIENT_FACTORIES = {
+    'fcm': GCM,
+    'fake': FakeGCM,
+}
+
 def cursored(func):
     ''' Creates a new cursor and self, executes function and then commits and 
-        closes the cursor'''
+        closes the cursor. Commit times are recorded in the bridge metrics'''
     def inner(self,*args,**kwargs):
         new_cr = self.pool.cursor()
-        self = self.with_env(self.env(cr=new_cr))
-        ret = func(self,*args,**kwargs)
-        new_cr.commit()
-        new_cr.close()
+        try:
+            self = self.with_env(self.env(cr=new_cr))
+            ret = func(self,*args,**kwargs)
+            start = time.monotonic()
+            new_cr.commit()
+            if self._name == 'firebase.bridge' and len(self) == 1:
+                self._get_metrics().observe('firebase_commit_seconds', time.monotonic() - start, job=func.__name__)
+        finally:
+            new_cr.close()
         return ret
     return inner
-        
+
+def read_cursored(func):
+    ''' Like cursored, but rolls back instead of committing: for jobs that
+        do not write'''
+    def inner(self,*args,**kwargs):
+        new_cr = self.pool.cursor()
+        try:
+            self = self.with_env(self.env(cr=new_cr))
+            ret = func(self,*args,**kwargs)
+            new_cr.rollback()
+        finally:
+            new_cr.close()
+        return ret
+    return inner
+
 class FirebaseBridge(models.Model):
     ''' Google FCM Bridge to Odoo API, using XMPP'''
     _name = 'firebase.bridge'
@@ -42,43 +89,251 @@ class FirebaseBridge(models.Model):
     server_key = fields.Char(_('Server Key'))
     server_domain = fields.Char('Firebase domain', default= 'fcm.googleapis.com')
     use_ssl = fields.Boolean(_('Use SSL'), default=True)
-    connected = fields.Boolean(_('Connected'), default=False)
+    transport = fields.Selection([
+        ('fcm', 'Firebase Cloud Messaging'),
+        ('fake', 'Fake FCM (benchmarks)'),
+    ], string=_('Transport'), default='fcm', required=True,
+        help=_('Fake FCM keeps messages in this process, see firebase_fake and firebase.benchmark'))
+    connected = fields.Boolean(_('Connected'), default=False,
+        help=_('At least one connection of the pool is up'))
+    pool_size = fields.Integer(_('Connections'), default=1,
+        help=_('Parallel XMPP connections to FCM. Each one carries at most "Max unacknowledged" messages in flight'))
+    connections_up = fields.Integer(_('Connections up'), default=0, readonly=True)
+    connection_state = fields.Selection([
+        ('down', 'Down'),
+        ('degraded', 'Degraded'),
+        ('up', 'Up'),
+    ], string=_('Pool state'), default='down', readonly=True)
+    metrics_summary = fields.Text(_('Metrics'), compute='_compute_metrics_summary',
+        help=_('Metrics of the bridge in this server process. Full metrics are served at /firebase/metrics'))
     session_ids = fields.One2many(comodel_name='firebase.session',inverse_name='bridge_id', string='Sessions')    
     session_timeout = fields.Integer(_('Session Timeout'),default=600)
+    message_batch = fields.Integer(_('Message batch size'), default=500,
+        help=_('Maximum number of pending messages fetched per query'))
+    rpc_workers = fields.Integer(_('RPC workers'), default=4,
+        help=_('Threads processing inbound messages. Messages from the same device are processed in order'))
+    rpc_queue = fields.Integer(_('RPC queue size'), default=1000,
+        help=_('Maximum inbound messages waiting for a worker. Beyond this, devices receive a busy reply'))
+    session_cache_ttl = fields.Integer(_('Session cache TTL'), default=300,
+        help=_('Seconds an authenticated device key is trusted without checking the database'))
+    read_cache_ttl = fields.Integer(_('Read cache TTL'), default=5,
+        help=_('Seconds the results of read RPCs (search_read, read, name_search) are reused for the same user and arguments. 0 disables it'))
+    max_batch = fields.Integer(_('Max batch calls'), default=20,
+        help=_('Calls accepted in a batch RPC message'))
+    heartbeat_interval = fields.Integer(_('Heartbeat flush interval'), default=30,
+        help=_('Seconds between bulk updates of session last visible times, and between ping rounds'))
+    ping_batch = fields.Integer(_('Ping batch size'), default=500,
+        help=_('Maximum sessions pinged per ping round'))
+    max_payload = fields.Integer(_('Max payload size'), default=MAX_PAYLOAD,
+        help=_('Maximum size in bytes of the data of a chunked RPC response message'))
+    rpc_page_size = fields.Integer(_('RPC page size'), default=200,
+        help=_('Records sent per page of a chunked RPC response. Further pages are fetched with the returned cursor'))
+    compress_threshold = fields.Integer(_('Compression threshold'), default=0,
+        help=_('Message data longer than this (in bytes) is sent zlib compressed and base64 encoded. 0 disables compression'))
+    delta_push = fields.Boolean(_('Delta pushes'), default=False,
+        help=_('Mixin models send only the fields changed since the last push to the partner'))
+    delta_persistent = fields.Boolean(_('Persist delta state'), default=False,
+        help=_('Keep the last pushed versions in the database, instead of only in memory'))
+    debounce_interval = fields.Integer(_('Debounce interval'), default=0,
+        help=_('Seconds record pushes wait before being sent. Pushes of the same record in the meantime are merged. 0 disables it'))
+    max_inflight = fields.Integer(_('Max unacknowledged'), default=100,
+        help=_('Messages sent and waiting for their ACK at most. FCM allows 100 per connection'))
+    ack_timeout = fields.Integer(_('ACK timeout'), default=60,
+        help=_('Seconds to wait for the ACK of a message before sending it again'))
+    max_attempts = fields.Integer(_('Max attempts'), default=8,
+        help=_('Delivery attempts before a message is marked failed. Retries are spaced with an exponential backoff'))
     
     def connect(self):
         logger.info("Fireserver %s connecting" % self.id)
         #self.write({'connected': False})
-        self.connected = False
-        thread_name = 'firebase-%s' % self.id
-        thread = threading.Thread(name=thread_name,target=self._run_thread, args=(self.id, self.server, self.port, self.use_ssl,self.server_id, self.server_domain,self.server_key))        
-        thread.start()
+        self.write(self._get_pool_state_vals(None))
+        runner.start(self.env.cr.dbname, self.id, self._run_bridge, self._get_connection_params(), on_exit=self._on_exit)
+    
+    def _get_connection_params(self):
+        ''' Settings read by the connection task, which runs outside any 
+            transaction'''
+        self.ensure_one()
+        return {
+            'server': self.server,
+            'port': self.port,
+            'use_ssl': self.use_ssl,
+            'server_id': self.server_id,
+            'server_domain': self.server_domain,
+            'server_key': self.server_key,
+            'rpc_workers': self.rpc_workers or 1,
+            'rpc_queue': self.rpc_queue or 1000,
+            'session_cache_ttl': self.session_cache_ttl or 0,
+            'read_cache_ttl': self.read_cache_ttl or 0,
+            'heartbeat_interval': self.heartbeat_interval or POLL_TIMEOUT,
+            'max_inflight': self.max_inflight or 100,
+            'ack_timeout': self.ack_timeout or 60,
+            'pool_size': max(1, min(self.pool_size or 1, MAX_POOL_SIZE)),
+            'transport': self.transport or 'fcm',
+        }
+    
+    def _get_pool_state_vals(self, conn):
+        ''' Values of the connection health fields for the runner connection'''
+        up = conn.healthy_count() if conn else 0
+        total = conn.pool_size() if conn else 0
+        return {
+            'connected': bool(up),
+            'connections_up': up,
+            'connection_state': 'up' if up and up == total else 'degraded' if up else 'down',
+        }
+    
+    def get_connection(self):
+        ''' Gets the runner connection of this bridge, if running'''
+        return runner.get(self.env.cr.dbname, self.id)
+    
+    def _get_metrics(self):
+        ''' Metrics of this bridge in this process'''
+        return get_metrics(self.env.cr.dbname, self.id)
+    
+    def _get_queue_depths(self):
+        ''' Number of messages waiting to be sent, by bridge id'''
+        self.env['firebase.message'].flush(['bridge_id', 'sent'])
+        self.env.cr.execute('''
+            SELECT bridge_id, count(*) FROM firebase_message
+             WHERE sent IS NULL AND bridge_id IN %s
+             GROUP BY bridge_id
+        ''', (tuple(self.ids) or (None,),))
+        return dict(self.env.cr.fetchall())
+    
+    def _get_metric_samples(self):
+        ''' (bridge_id, metrics, gauges) of the bridges, for render'''
+        depths = self._get_queue_depths()
+        samples = []
+        for record in self:
+            conn = record.get_connection()
+            gauges = {'firebase_queue_depth': depths.get(record.id, 0)}
+            if conn:
+                gauges.update({
+                    'firebase_inflight': conn.inflight,
+                    'firebase_rpc_pending': conn.dispatcher.pending if conn.dispatcher else 0,
+                    'firebase_connections_up': conn.healthy_count(),
+                })
+            samples.append((record.id, record._get_metrics(), gauges))
+        return samples
     
-    def get_thread(self):
-        ''' Gets the thread running the XMPP connection, based on the id'''
-        thread_name = 'firebase-%s' % self.id
-        for t in threading.enumerate():
-            if t.name == thread_name:
-                return t
+    def render_metrics(self):
+        ''' Metrics of the bridges in Prometheus text format'''
+        return render(self._get_metric_samples())
+    
+    def _compute_metrics_summary(self):
+        def quantiles(histogram):
+            if not histogram or not histogram.count:
+                return '-'
+            return 'p50 <= %ss, p99 <= %ss (%s)' % (histogram.quantile(0.5), histogram.quantile(0.99), histogram.count)
+        samples = {bridge_id: (metrics, gauges) for bridge_id, metrics, gauges in self.filtered('id')._get_metric_samples()}
+        for record in self:
+            if record.id not in samples:
+                record.metrics_summary = False
+                continue
+            metrics, gauges = samples[record.id]
+            hits = metrics.value('firebase_auth_cache_total', result='hit')
+            misses = metrics.value('firebase_auth_cache_total', result='miss')
+            lines = [
+                _('Queue depth: %s, in flight: %s, RPC pending: %s') % (
+                    gauges['firebase_queue_depth'], gauges.get('firebase_inflight', 0), gauges.get('firebase_rpc_pending', 0)),
+                _('Sent: %s, failed: %s, ACK: %s, NACK: %s, reconnects: %s') % (
+                    metrics.value('firebase_messages_sent_total'), metrics.value('firebase_messages_failed_total'),
+                    metrics.value('firebase_acks_total', result='ack'), metrics.value('firebase_acks_total', result='nack'),
+                    metrics.value('firebase_reconnects_total')),
+                _('Auth cache hit rate: %s') % ('%.1f%%' % (100.0 * hits / (hits + misses)) if hits + misses else '-'),
+                _('Message age: %s') % quantiles(metrics.histogram('firebase_message_age_seconds')),
+            ]
+            for stage in ('queue', 'fetch', 'serialize', 'send', 'commit', 'batch'):
+                lines.append(_('Stage %s: %s') % (stage, quantiles(metrics.histogram('firebase_stage_seconds', stage=stage))))
+            _counters, histograms = metrics.snapshot()
+            rpcs = sorted(((dict(labels), h) for (name, labels), h in histograms.items() if name == 'firebase_rpc_seconds'),
+                          key=lambda i: -i[1].count)
+            for labels, histogram in rpcs[:10]:
+                lines.append(_('RPC %s.%s: %s') % (labels.get('model'), labels.get('method'), quantiles(histogram)))
+            record.metrics_summary = '\n'.join(lines)
     
     def _get_messages(self):
-        return self.env['firebase.message'].search([('sent','=',None)])
+        ''' Locks and returns the next batch of pending messages of this bridge.
+            Rows locked by another worker are skipped, so several workers can 
+            drain the same bridge.'''
+        self.env['firebase.message'].flush(['bridge_id', 'sent', 'created'])
+        self.env.cr.execute('''
+            SELECT id FROM firebase_message
+             WHERE bridge_id = %s AND sent IS NULL
+               AND (send_after IS NULL OR send_after <= now() at time zone 'UTC')
+             ORDER BY created, id
+             LIMIT %s
+               FOR UPDATE SKIP LOCKED
+        ''', (self.id, self.message_batch or 500))
+        return self.env['firebase.message'].browse([r[0] for r in self.env.cr.fetchall()])
+
+    def _set_next_due(self, conn):
+        ''' Records when the next deferred message (debounced push, retry
+            backoff) of the bridge is due, for the loop to wake up then'''
+        self.env['firebase.message'].flush(['bridge_id', 'sent', 'send_after'])
+        self.env.cr.execute('''
+            SELECT extract(epoch FROM min(send_after) - now() at time zone 'UTC')
+              FROM firebase_message
+             WHERE bridge_id = %s AND sent IS NULL AND send_after > now() at time zone 'UTC'
+        ''', (self.id,))
+        delay = self.env.cr.fetchone()[0]
+        conn.next_due = time.monotonic() + float(delay) if delay is not None else None
         
     def disconnect(self):
-        t = self.get_thread()
-        if t:
-            t._fstopped = True
+        runner.stop(self.env.cr.dbname, self.id)
+
+    @cursored
+    def _on_exit(self, conn):
+        ''' Marks the bridge down once its connection task is over, unless
+            a new connection took over meanwhile'''
+        if not self.get_connection():
+            self.write(self._get_pool_state_vals(None))
 
     @cursored
-    def message_loop(self, xmpp):
-        logger.info("[Firebase Bridge] Checking messages")
-        for message in self._get_messages():
-            rtt = fields.Datetime.now()
+    def _flush_acks(self, conn):
+        self._store_acks(conn)
+        self._set_next_due(conn)
+
+    @cursored
+    def message_loop(self, conn):
+        logger.debug("[Firebase Bridge] Checking messages")
+        metrics = conn.metrics
+        self._store_acks(conn)
+        while True:
+            start = time.monotonic()
+            with metrics.timer('firebase_stage_seconds', stage='fetch'):
+                messages = self._get_messages()
+            sent, failed = self._send_messages(conn, messages)
+            # One UPDATE per batch, then commit releasing its row locks
+            sent.write({'sent': fields.Datetime.now(), 'state': 'sent'})
+            with metrics.timer('firebase_stage_seconds', stage='commit'):
+                self.env.cr.commit()
+            if messages:
+                elapsed = time.monotonic() - start
+                metrics.inc('firebase_batches_total')
+                metrics.inc('firebase_messages_sent_total', len(sent))
+                metrics.inc('firebase_messages_failed_total', len(failed))
+                metrics.observe('firebase_stage_seconds', elapsed, stage='batch')
+                logger.debug('[Firebase Bridge] %s batch: %s sent, %s failed in %.3fs', self.name, len(sent), len(failed), elapsed)
+            # Stop on a short batch, or if nothing could be delivered
+            if not sent or not conn.healthy_count() or len(messages) < (self.message_batch or 500):
+                break
+        self._set_next_due(conn)
+
+    def _send_messages(self, conn, messages):
+        ''' Sends messages on the connection's XMPP stream. 
+            Returns the (sent, failed) recordsets: a message is sent once 
+            all its destinations are. Failed ones were not handed off to FCM
+            (pool down or saturated): they are left queued as they are, 
+            without counting an attempt'''
+        payloads = []
+        for message in messages:
             msg = {
                 'type': message.type,
                 'model': message.model,
                 'data': message.data,                
             }
+            if message.encoding:
+                msg['encoding'] = message.encoding
             options = {}
             if message.type == 'notification':
                 options = {
@@ -97,67 +352,272 @@ class FirebaseBridge(models.Model):
                     'topic': 'Notif'
                 }
             # print(msg,options)
-            devices = self._get_partner_devices(message)
-            for device in devices:
-                xmpp.send_gcm(device,msg,options=options)
-                # logger.info('[Firebase Bridge] Message %s sent to %s in %s',message.name, message.partner_id, (fields.Datetime.now() - rtt).total_seconds() )
-            message.sent = fields.Datetime.now()
+            # One payload, fanned out to every pending destination
+            for recipient, to in message._get_destinations():
+                payloads.append(((message.id, recipient.id), [to], msg, options))
+        failed_keys = set()
+        if payloads:
+            # slixmpp is not thread-safe: sends happen on the runner loop
+            with conn.metrics.timer('firebase_stage_seconds', stage='send'):
+                failed_keys = set(runner.call(conn.send_batch(payloads)))
+        Recipient = self.env['firebase.message.recipient']
+        Recipient.browse([k[1] for k, _to, _d, _o in payloads if k[1] and k not in failed_keys]).write({'sent': fields.Datetime.now(), 'state': 'sent'})
+        failed = messages.browse({k[0] for k in failed_keys})
+        sent = messages - failed
+        now = fields.Datetime.now()
+        for message in sent:
+            age = (now - message.created).total_seconds()
+            conn.metrics.observe('firebase_message_age_seconds', max(age, 0))
+            logger.debug('[Firebase Bridge] Message %s sent to %s %.3fs after creation',message.name, message.partner_id, age)
+        return sent, failed
 
-    
-    def _run_thread(self,bridge_id,server,port,use_ssl,server_id,server_domain,server_key):
-        
-        logger.info("Starting Firebase thread %s: %s,%s,%s,%s,%s,%s", bridge_id,server,port,use_ssl,server_id,server_domain,server_key)
-        t = threading.currentThread()
-        t._fstopped = False
-        t._attempts = 0
-        t.server = server
-        t.port = port
-        t.use_ssl = use_ssl
-        
-        try:
-            asyncio.get_event_loop()
-        except RuntimeError:
-            # slixmpp can not handle not having an event_loop
-            # see: https://lab.louiz.org/poezio/slixmpp/-/issues/3456
-            # This is a work-around to this problem
-            asyncio.set_event_loop(asyncio.new_event_loop())
+    def _store_acks(self, conn):
+        ''' Stores the ACKs/NACKs received since the last call. Delivered
+            messages are marked so, retryable errors are sent again later and
+            devices with an invalid token get their sessions closed.
+            ACKs of pings have no stored message, only invalid tokens matter'''
+        acks = conn.pop_acks()
+        if not acks:
+            return
+        Message = self.env['firebase.message']
+        Recipient = self.env['firebase.message.recipient']
+        now = fields.Datetime.now()
+        delivered, retry, failed = defaultdict(set), defaultdict(lambda: defaultdict(set)), defaultdict(lambda: defaultdict(set))
+        invalid = set()
+        for key, device, error in acks:
+            if error in INVALID_TOKEN_ERRORS:
+                invalid.add(device)
+            if not isinstance(key, tuple):
+                continue
+            message_id, recipient_id = key
+            model, res_id = ('recipient', recipient_id) if recipient_id else ('message', message_id)
+            if not error:
+                delivered[model].add(res_id)
+            elif error in RETRY_ERRORS:
+                retry[error][model].add(res_id)
+            else:
+                failed[error][model].add(res_id)
+        Message.browse(delivered['message']).write({'state': 'delivered', 'acked': now})
+        Recipient.browse(delivered['recipient']).write({'state': 'delivered', 'acked': now})
+        for error, ids in failed.items():
+            Message.browse(ids['message']).write({'state': 'failed', 'error': error})
+            Recipient.browse(ids['recipient']).write({'state': 'failed', 'error': error})
+        for error, ids in retry.items():
+            Message.browse(ids['message'])._retry(error, self.max_attempts)
+            Recipient.browse(ids['recipient'])._retry(error, self.max_attempts)
+        Recipient.browse(delivered['recipient'] | {i for ids in failed.values() for i in ids['recipient']}).message_id._update_delivered()
+        if invalid:
+            sessions = self.env['firebase.session'].search([('device', 'in', list(invalid)), ('closed', '=', False)])
+            sessions.write({'closed': True})
+            logger.info('Firebase Bridge %s: closed %s sessions of %s unregistered devices', self.id, len(sessions), len(invalid))
+        logger.debug('Firebase Bridge %s: stored %s acks', self.id, len(acks))
+
+    async def _run_bridge(self, conn, params):
+        ''' Bridge connection task, running on the runner loop'''
+        bridge_id = conn.bridge_id
+        logger.info("Starting Firebase bridge %s: %s,%s,%s,%s,%s", bridge_id, params['server'], params['port'], params['use_ssl'], params['server_id'], params['server_domain'])
+        conn.address = (params['server'], params['port'])
+        conn.use_ssl = params['use_ssl']
+        conn.max_inflight = params['max_inflight']
+        conn.ack_timeout = params['ack_timeout']
+        conn.dispatcher = KeyedDispatcher(
+            runner.loop,
+            ThreadPoolExecutor(max_workers=params['rpc_workers'], thread_name_prefix='firebase-rpc-%s' % bridge_id),
+            params['rpc_queue'],
+            conn.metrics)
+        conn.sessions = SessionCache(params['session_cache_ttl'])
+        conn.reads = TTLCache(params['read_cache_ttl'], 4096) if params['read_cache_ttl'] else None
+        conn.params = params
         
-        xmpp = GCM('%s@%s' % (server_id, server_domain), server_key)
-        t.xmpp = xmpp
-        xmpp.default_port = port
-
-        xmpp.add_event_handler(XMPPEvent.CONNECTED, self.on_connected)
-        xmpp.add_event_handler(XMPPEvent.DISCONNECTED, self.on_disconnected)
-        xmpp.add_event_handler(XMPPEvent.RECEIPT, self.on_receipt)
-        xmpp.add_event_handler(XMPPEvent.MESSAGE, self.on_message)
-        xmpp.connect((server, port), use_ssl=use_ssl) 
+        for index in range(params['pool_size']):
+            self._add_member(conn, index)
         
-        while not threading.currentThread()._fstopped:
-            xmpp.process(forever=True, timeout=5)
-            self.message_loop(xmpp)          
+        # Woken up by the runner as soon as a firebase.message is committed,
+        # or an ACK is received
+        heartbeat_interval = params['heartbeat_interval']
+        next_flush = time.monotonic() + heartbeat_interval
+        next_poll = time.monotonic()
+        while not conn.stopped:
+            timeout = min(POLL_TIMEOUT, heartbeat_interval, params['ack_timeout'])
+            if conn.polling:
+                timeout = min(timeout, max(0, next_poll - time.monotonic()))
+            elif conn.next_due is not None and conn.healthy_count():
+                # Deferred messages are not notified when they become due
+                timeout = min(timeout, max(0, conn.next_due - time.monotonic()))
+            await conn.wait(timeout)
+            try:
+                conn.expire_inflight(params['ack_timeout'])
+                polled = not conn.polling or time.monotonic() >= next_poll
+                # Messages stay queued while every stream is down or draining
+                if not conn.stopped and conn.healthy_count() and polled:
+                    await runner.run_db(self.message_loop, conn)
+                    next_poll = time.monotonic() + conn.polling
+                elif conn.acks:
+                    await runner.run_db(self._flush_acks, conn)
+                if conn.stopped or time.monotonic() >= next_flush:
+                    await runner.run_db(self._flush_heartbeats, conn)
+                    if not conn.stopped and conn.healthy_count():
+                        await runner.run_db(self._ping_round, conn)
+                    next_flush = time.monotonic() + heartbeat_interval
+            except Exception:
+                # e.g. the database went away: keep the streams, retry later
+                logger.exception('Firebase Bridge %s: message loop failed', bridge_id)
+                await asyncio.sleep(RECONNECT_BASE)
 
-        xmpp.disconnect(0.0)
+        conn.close()
+        # Unacknowledged messages will be sent again by the next connection
+        conn.expire_inflight(error='CONNECTION_LOST')
+        await runner.run_db(self._flush_acks, conn)
         logger.warning('Firebase Bridge %s exiting' % bridge_id)
         
 
+    def _new_client(self, conn, params):
+        ''' Creates an XMPP client of the connection pool, with its event 
+            handlers'''
+        factory = self._get_client_factory(params)
+        xmpp = factory('%s@%s' % (params['server_id'], params['server_domain']), params['server_key'])
+        xmpp.default_port = params['port']
+        xmpp.add_event_handler(XMPPEvent.CONNECTED, lambda data: self._handle_connected(conn, xmpp, data))
+        xmpp.add_event_handler(XMPPEvent.DISCONNECTED, lambda draining: self._handle_disconnected(conn, xmpp, draining))
+        xmpp.add_event_handler(XMPPEvent.RECEIPT, lambda data: runner.spawn_db(self.on_receipt, data))
+        xmpp.add_event_handler(XMPPEvent.MESSAGE, lambda message: self._handle_message(conn, message))
+        return xmpp
+
+    def _get_client_factory(self, params):
+        ''' XMPP client class of the connection. Override to inject another
+            client'''
+        return CLIENT_FACTORIES[params['transport']]
+
+    def _get_member(self, conn, xmpp):
+        return next((m for m in conn.members if m.xmpp is xmpp), None)
+
+    def _add_member(self, conn, index):
+        ''' Adds a stream to the pool and starts its supervisor'''
+        member = PoolMember(index, self._new_client(conn, conn.params))
+        conn.members.append(member)
+        runner.loop.create_task(self._supervise(conn, member))
+        return member
+
+    async def _supervise(self, conn, member):
+        ''' Connects the stream until it is up, waiting between attempts 
+            with a jittered exponential backoff. Never gives up while the 
+            bridge runs'''
+        if member.supervised:
+            return
+        member.supervised = True
+        try:
+            while not (conn.stopped or member.retired or member.connected):
+                if member.attempts:
+                    delay = min(RECONNECT_MAX, RECONNECT_BASE * 2 ** min(member.attempts, 16)) * random.uniform(0.5, 1)
+                    logging.info('Firebase Bridge %s reconnecting stream %s in %.1fs. attempt #%s' % (conn.bridge_id, member.index, delay, member.attempts))
+                    await asyncio.sleep(delay)
+                    if conn.stopped or member.retired:
+                        break
+                    conn.metrics.inc('firebase_reconnects_total')
+                member.attempts += 1
+                try:
+                    member.xmpp.connect(conn.address, use_ssl=conn.use_ssl)
+                except Exception:
+                    logger.exception('Firebase Bridge %s: stream %s connection failed', conn.bridge_id, member.index)
+                    continue
+                await member.wait_connected(CONNECT_TIMEOUT)
+        finally:
+            member.supervised = False
+
+    def _replace(self, conn, member):
+        ''' Opens a replacement for a draining stream, which keeps receiving
+            the ACKs of its messages in flight until it is closed'''
+        member.retired = True
+        self._add_member(conn, member.index)
+        runner.loop.create_task(self._retire(conn, member))
+
+    async def _retire(self, conn, member):
+        ''' Closes a draining stream once its messages are acknowledged, if
+            FCM did not close it first'''
+        deadline = time.monotonic() + conn.params['ack_timeout']
+        while member.inflight and member in conn.members and time.monotonic() < deadline:
+            await asyncio.sleep(1)
+        if member in conn.members:
+            member.xmpp.disconnect(0.0)
+
+    def _handle_message(self, conn, message):
+        ''' Runs on the loop: queues the inbound message in the RPC pool, 
+            keeping messages of the same device in order'''
+        device = message.data.get('from')
+        data = message.data.get('data') or {}
+        # Reads skip the commit and message storage while the pool is up
+        func = self.on_read_message if conn.healthy_count() and self._is_read_only(data) else self.on_message
+        if not conn.dispatcher.submit(device, func, message):
+            logger.warning('Firebase Bridge %s busy, rejecting message from %s' % (conn.bridge_id, device))
+            # Best effort, through the pool accounting: dropped when no 
+            # stream has a free slot
+            if conn.healthy_count():
+                busy = {'type': 'busy', 'model': data.get('model'), 'data': '{}'}
+                runner.loop.create_task(conn.send_batch([('busy', [device], busy, {})], timeout=1))
+
+    def _handle_connected(self, conn, xmpp, queue_length):
+        ''' Runs on the loop: puts the stream back in the pool'''
+        member = self._get_member(conn, xmpp)
+        if member is None:
+            return
+        member.connected = True
+        member.attempts = 0 # Reset connection attempts
+        member.up.set()
+        conn.wake()
+        logging.info('Firebase Bridge %s connected (%s/%s)' % (conn.bridge_id, conn.healthy_count(), conn.pool_size()))
+        self._sync_pool_state(conn)
+
+    def _handle_disconnected(self, conn, xmpp, draining):
+        ''' Runs on the loop: takes the stream out of the pool and has it
+            reconnected, while the DB update is offloaded. A draining stream 
+            stops taking new messages and is replaced right away'''
+        member = self._get_member(conn, xmpp)
+        if member is None:
+            return
+        if draining:
+            if not member.draining and not conn.stopped:
+                member.draining = True
+                self._replace(conn, member)
+        else:
+            member.connected = False
+            member.up.clear()
+            # ACKs of messages in flight are lost with the stream
+            conn.expire_inflight(error='CONNECTION_LOST', members=[member])
+            if member.retired:
+                conn.members.remove(member)
+            elif not conn.stopped:
+                runner.loop.create_task(self._supervise(conn, member))
+        logging.info('Firebase Bridge %s %s (%s/%s up)' % (conn.bridge_id, 'draining' if draining else 'disconnected', conn.healthy_count(), conn.pool_size()))
+        self._sync_pool_state(conn)
+
+    def _sync_pool_state(self, conn):
+        ''' Runs on the loop: stores the pool state of the bridge. Events of
+            the pool members are coalesced into one job at a time, so they
+            do not race updating the bridge row. Once the connection is 
+            closed, _on_exit stores the final state'''
+        if conn.closed:
+            return
+        conn.state_dirty = True
+        if conn.state_sync is None:
+            conn.state_dirty = False
+            conn.state_sync = runner.spawn_db(self._store_pool_state, conn)
+            conn.state_sync.add_done_callback(lambda future: self._pool_state_synced(conn, future))
+
+    def _pool_state_synced(self, conn, future):
+        conn.state_sync = None
+        if not future.cancelled() and future.exception():
+            # e.g. a serialization failure: try again with the latest state
+            runner.loop.call_later(RECONNECT_BASE, self._sync_pool_state, conn)
+        elif conn.state_dirty:
+            self._sync_pool_state(conn)
+
     @cursored
-    def on_connected(self,queue_length):
-        logging.info('Firebase Bridge %s connected' % self.name)
-        self.get_thread()._attempts = 0 # Reset connection attempts
-        self.connected = True
-        
-    @cursored
-    def on_disconnected(self, draining):
-        logging.info('Firebase Bridge %s disconnected' % self.name)
-        self.connected = False
-        t = self.get_thread()
-        if t._attempts < 3:
-            t._attempts = t._attempts +1
-            logging.info('Firebase Bridge %s reconnecting. attempt #%s' % (self.id, t._attempts))
-            t.xmpp.connect((self.server, self.port), use_ssl=self.use_ssl) 
+    def _store_pool_state(self, conn):
+        self.write(self._get_pool_state_vals(conn))
 
     @cursored
     def on_receipt(self,data):
+        ''' Delivery receipts are only logged: ACKs already track messages'''
         logging.debug('Firebase Bridge %s receipt: %s' % (self.name, data))
         
     @cursored
@@ -170,28 +630,73 @@ class FirebaseBridge(models.Model):
             return
         if msg_type == 'login':
             self.authenticate(message)
+        elif self._authenticate_message(message):
+            if msg_type == 'rpc':
+                self.do_rpc(message)
+            elif msg_type == 'batch':
+                self.do_batch(message)
+            elif msg_type == 'resync':
+                self.resync(message)
+            # elif msg_type == 'pong':
+            #     print("pong received from",device,key)
+
+    @read_cursored
+    def on_read_message(self,message):
+        ''' on_message for read-only RPCs and batches: replies are sent 
+            straight on the XMPP connection and nothing is committed'''
+        data = message.data.get('data')
+        msg_type = data.pop('type',None)
+        if not self._authenticate_message(message):
+            return
+        self._get_metrics().inc('firebase_rpc_readonly_total')
+        self = self.with_context(firebase_direct_reply=True)
+        if msg_type == 'batch':
+            self.do_batch(message)
         else:
-            # TODO: extract key authentication function
-            device = message.data.get('from')
-            key = message.data.get('data').pop('key',None)
-            session = self._get_session(device,key)
-            if session:
-                session.set_last(fields.Datetime.now())
-                message.data['key'] = key
-                message.data['user_id'] = session.user_id.id
-                if msg_type == 'rpc':
-                    self.do_rpc(message)
-                # elif msg_type == 'pong':
-                #     print("pong received from",device,key)
-            else:
-                logger.warning('Unauthorized access. device:%s, key:%s, data:%s' % (device,key,message.data.get('data')))
-
-    def _get_partner_devices(self,message):
-        if message.device:
-            return [message.device]
-        sessions = self.session_ids.filtered(lambda x: x.partner_id.id == message.partner_id.id and x.is_active == True)
-        # logger.info('_get_partner_devices sessions: %s' % sessions)
-        return [s.device for s in sessions]
+            self.do_rpc(message)
+
+    def _authenticate_message(self,message):
+        ''' Checks the session key of an inbound message, and stores the 
+            session's user and partner in it'''
+        device = message.data.get('from')
+        key = message.data.get('data').pop('key',None)
+        auth = self._authenticate_key(device,key)
+        if not auth:
+            logger.warning('Unauthorized access. device:%s, key:%s, data:%s' % (device,key,message.data.get('data')))
+            return False
+        message.data['key'] = key
+        message.data['user_id'] = auth[1]
+        message.data['partner_id'] = auth[2]
+        return True
+
+    def _get_calls(self,data):
+        ''' Calls of a batch message: a list, or its JSON'''
+        calls = data.get('calls') or []
+        if isinstance(calls,str):
+            calls = json.loads(calls)
+        return calls
+
+    def _is_read_only(self,data):
+        ''' Whether an inbound message only calls READ_METHODS'''
+        msg_type = data.get('type')
+        if msg_type == 'rpc':
+            return not data.get('cursor') and data.get('method') in READ_METHODS
+        if msg_type == 'batch':
+            try:
+                calls = self._get_calls(data)
+            except ValueError:
+                return False
+            return bool(calls) and all(isinstance(c,dict) and c.get('method') in READ_METHODS for c in calls)
+        return False
+
+    def _get_active_sessions(self,partner_ids,limit=None):
+        ''' Active sessions of the given partners on this bridge'''
+        self.ensure_one()
+        FirebaseSession = self.env['firebase.session']
+        return FirebaseSession.search(expression.AND([
+            [('bridge_id','=',self.id),('partner_id','in',list(partner_ids))],
+            FirebaseSession._get_active_domain(self),
+        ]), limit=limit)
     
     def _get_session(self,device,key):
         FirebaseSession = self.env['firebase.session']
@@ -200,13 +705,66 @@ class FirebaseBridge(models.Model):
         if session_id:
             return FirebaseSession.browse(int(session_id[0]))
 
+    def _authenticate_key(self,device,key):
+        ''' Checks device's session key, through the connection's session cache.
+            Returns (session_id, user_id, partner_id) or None.
+            The session heartbeat is recorded and flushed later in bulk'''
+        now = fields.Datetime.now()
+        conn = self.get_connection()
+        cache = conn and conn.sessions
+        info = cache and cache.get(device,key)
+        if cache:
+            conn.metrics.inc('firebase_auth_cache_total', result='hit' if info else 'miss')
+        if not info:
+            session = self._get_session(device,key)
+            if not session:
+                return None
+            info = (session.id, session.user_id.id, session.partner_id.id)
+            if not cache:
+                session.set_last(now)
+                return info
+            cache.put(device,key,info)
+        cache.touch(info[0], info[2], now)
+        return info
+
+    @cursored
+    def _flush_heartbeats(self, conn):
+        ''' Writes coalesced session heartbeats, one UPDATE per distinct time'''
+        heartbeats = conn.sessions.pop_heartbeats()
+        if not heartbeats:
+            return
+        sessions, partners = defaultdict(list), defaultdict(set)
+        for session_id, (partner_id, last) in heartbeats.items():
+            sessions[last].append(session_id)
+            if partner_id:
+                partners[last].add(partner_id)
+        FirebaseSession = self.env['firebase.session']
+        for last, ids in sessions.items():
+            FirebaseSession.browse(ids).write({'last': last})
+        Partner = self.env['res.partner']
+        if 'firebase_last' in Partner._fields:
+            # a partner seen at several times keeps the latest
+            for last in sorted(partners):
+                Partner.browse(list(partners[last])).write({'firebase_last': last})
+        logger.debug('Firebase Bridge %s: flushed %s heartbeats', self.id, len(heartbeats))
+
             
     def do_rpc(self,message):
         ''' Make API call.
             Response will be sent in FCM messages to device.
+            If the request carries a correlation id, the response is sent 
+            as size-bounded 'objects' chunks (see encode_chunks), one page
+            at a time. A request with a 'cursor' fetches the next page, or
+            gets a chunk with error 'cursor_expired' if it is gone. 
+            Correlated requests always get a reply, unless they ask for none:
+            no records for empty results, an error chunk if the call failed.
+            Otherwise one 'object' message is sent per returned record.
             TODO: add option to NOT send response.
         '''
         data = message.data.get('data')
+        if data.get('cursor'):
+            return self._send_next_page(message)
+        correlation_id = data.get('id')
         model = data.get('model')
         method = data.get('method')
         split_method = method.split('-nr')
@@ -218,43 +776,255 @@ class FirebaseBridge(models.Model):
         
         logger.debug('do_rpc (uid:%s): %s,%s,%s,%s' % (user_id,model,method, fn_args,fn_kwargs))
         
-        obj = self.env[model].with_user(user_id)
-        fn = getattr(obj,method)
+        metrics = self._get_metrics()
         try:
-            ret = fn(*fn_args,**fn_kwargs)
-        except:
+            # Rolled back on error, so that the error reply can be stored
+            with self.env.cr.savepoint():
+                ret, read_fields = self._call(user_id,model,method,fn_args,fn_kwargs)
+        except Exception as e:
             logger.warn('do_rpc (uid:%s): %s,%s,%s,%s' % (user_id,model,method, fn_args,fn_kwargs))
             logger.exception("Exception while rpc")
-            ret=False
+            if correlation_id is not None and not no_return:
+                self._send_error(message.data.get('from'),model,correlation_id,str(e))
+            return
         
         # Normalize return type
-        if no_return or not ret or isinstance(ret,bool):
+        if no_return:
+            return
+        if correlation_id is not None:
+            # Always replied, so that the client can tell "no records" from
+            # a lost message
+            if not ret or isinstance(ret,bool):
+                ret = []
+            elif isinstance(ret,str):
+                ret = json.loads(ret)
+            self._send_response(message.data.get('from'),user_id,model,correlation_id,ret,read_fields)
+            return
+        if not ret or isinstance(ret,bool):
             return
         if isinstance(ret,str):
             ret = json.loads(ret)
-        elif inspect.isclass(ret):
-            ret = ret.read()
+        start = time.monotonic()
+        if inspect.isclass(ret):
+            ret = ret.read(read_fields)
         elif isinstance(ret,models.Model):
-            ret = ret.read()
+            ret = ret.read(read_fields)
         
         # print('do_rpc ret:', type(ret),ret)
         
         if ret:
+            vals_list = []
             for obj in ret:
                 if isinstance(obj,models.Model):
-                    obj = obj.read()[0]
-                msg = {
+                    obj = obj.read(read_fields)[0]
+                vals_list.append({
                     'bridge_id': self.id,
                     'device': message.data.get('from'),
                     'type': 'object',
                     'model': model,
-                    'data': json.dumps(obj, default=date_utils.json_default)
-                }
-                self.create_message(msg)
+                    'data': dumps(obj)
+                })
+            metrics.observe('firebase_stage_seconds', time.monotonic() - start, stage='serialize')
+            self._reply(vals_list)
+
+    def _call(self,user_id,model,method,fn_args,fn_kwargs,use_cache=True):
+        ''' Runs model.method(*fn_args, **fn_kwargs) as user_id, projecting
+            fields. Results of READ_METHODS are cached per user and 
+            arguments for read_cache_ttl, unless use_cache is False. Any 
+            other method drops the cached results of the user, so that they
+            read their own writes. Returns (result, read_fields), 
+            read_fields being the fields to read from returned records'''
+        conn = self.get_connection()
+        cache = conn.reads if conn and use_cache and method in READ_METHODS else None
+        metrics = self._get_metrics()
+        if cache is not None:
+            cache_key = (user_id,model,method,dumps(fn_args),dumps(fn_kwargs))
+            cached = cache.get(cache_key)
+            metrics.inc('firebase_read_cache_total', result='hit' if cached else 'miss')
+            if cached:
+                return cached
+        obj = self.env[model].with_user(user_id)
+        fn = getattr(obj,method)
+        # Field projection: methods taking fields get the whitelisted ones,
+        # for the others fields applies to the returned records
+        Projection = self.env['firebase.projection']
+        signature = inspect.signature(fn)
+        if 'fields' in signature.parameters:
+            read_fields = None
+            # fields may be passed positionally as well
+            try:
+                bound = signature.bind_partial(*fn_args,**fn_kwargs)
+            except TypeError:
+                bound = None  # the call raises it again
+            projected = Projection._project(model,bound.arguments.get('fields')) if bound is not None else None
+            if projected is not None:
+                bound.arguments['fields'] = projected
+                fn_args, fn_kwargs = list(bound.args), dict(bound.kwargs)
+        else:
+            read_fields = Projection._project(model,fn_kwargs.pop('fields',None))
+        start = time.monotonic()
+        try:
+            ret = fn(*fn_args,**fn_kwargs)
+        except Exception:
+            metrics.inc('firebase_rpc_errors_total', model=model, method=method)
+            raise
+        finally:
+            metrics.observe('firebase_rpc_seconds', time.monotonic() - start, model=model, method=method)
+            if conn and conn.reads is not None and method not in READ_METHODS:
+                conn.reads.invalidate(lambda k: k[0] == user_id)
+        if cache is not None and not isinstance(ret,models.Model):
+            cache.put(cache_key,(ret,read_fields))
+        return ret, read_fields
+
+    def do_batch(self,message):
+        ''' Runs several calls under one authentication and one cursor.
+            data has a correlation id and calls, a list (or its JSON) of 
+            {id, model, method, args, kwargs}. Calls run in order, each one
+            in a savepoint, so a failing call does not affect the others.
+            The response is a set of 'batch' chunks (see encode_chunks) of
+            one {id, result} or {id, error} record per call'''
+        data = message.data.get('data')
+        user_id = message.data.get('user_id')
+        try:
+            calls = self._get_calls(data)
+        except ValueError:
+            calls = []
+        max_batch = self.max_batch or 20
+        # Reads following a write of the batch must see it
+        use_cache = all(isinstance(call,dict) and call.get('method') in READ_METHODS for call in calls)
+        results = []
+        for i, call in enumerate(calls):
+            call_id = call.get('id', i) if isinstance(call,dict) else i
+            if i >= max_batch:
+                results.append({'id': call_id, 'error': 'Too many calls (max %s)' % max_batch})
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    fn_args = call.get('args') or []
+                    fn_kwargs = call.get('kwargs') or {}
+                    if isinstance(fn_args,str):
+                        fn_args = json.loads(fn_args)
+                    if isinstance(fn_kwargs,str):
+                        fn_kwargs = json.loads(fn_kwargs)
+                    ret, read_fields = self._call(user_id,call.get('model'),call.get('method'),fn_args,fn_kwargs,use_cache)
+                    results.append({'id': call_id, 'result': self._serialize_result(ret,read_fields)})
+            except Exception as e:
+                logger.warning('do_batch (uid:%s): call %s failed: %s' % (user_id,call_id,e))
+                results.append({'id': call_id, 'error': str(e)})
+        with self._get_metrics().timer('firebase_stage_seconds', stage='serialize'):
+            chunks = encode_chunks(results,data.get('id'),None,self.max_payload or MAX_PAYLOAD)
+        self._reply([{
+            'bridge_id': self.id,
+            'device': message.data.get('from'),
+            'type': 'batch',
+            'model': False,
+            'data': chunk,
+        } for chunk in chunks])
+
+    def _serialize_result(self,ret,read_fields=None):
+        ''' JSON-ready version of a call result'''
+        if isinstance(ret,models.Model):
+            return ret.read(read_fields)
+        if isinstance(ret,str):
+            try:
+                return json.loads(ret)
+            except ValueError:
+                return ret
+        if isinstance(ret,(list,tuple)):
+            return [r.read(read_fields)[0] if isinstance(r,models.Model) else r for r in ret]
+        return ret
+
+    def _reply(self,vals_list):
+        ''' Sends RPC replies, stored as firebase.message. On the read-only
+            path they are sent straight on the XMPP connection instead, 
+            those that could not be sent are stored'''
+        if not self.env.context.get('firebase_direct_reply'):
+            return self.create_messages(vals_list)
+        conn = self.get_connection()
+        payloads = []
+        for i, vals in enumerate(vals_list):
+            data, encoding = compress(vals['data'],self.compress_threshold)
+            msg = {'type': vals['type'], 'model': vals.get('model'), 'data': data}
+            if encoding:
+                msg['encoding'] = encoding
+            payloads.append(('reply-%s' % i,[vals['device']],msg,{}))
+        failed = set(runner.call(conn.send_batch(payloads))) if conn else {p[0] for p in payloads}
+        if failed:
+            logger.warning('Firebase Bridge %s: storing %s replies that could not be sent' % (self.id, len(failed)))
+            self._store_replies([vals for (key, _to, _d, _o), vals in zip(payloads,vals_list) if key in failed])
+
+    @cursored
+    def _store_replies(self,vals_list):
+        self.create_messages(vals_list)
+
+    def _send_response(self,device,user_id,model,correlation_id,ret,read_fields=None):
+        ''' Sends the first page of ret as chunked 'objects' messages. 
+            The rest of the records is kept under a cursor, returned to the 
+            client in every chunk'''
+        if not isinstance(ret,(list,tuple,models.Model)):
+            ret = [ret]
+        page_size = self.rpc_page_size or len(ret)
+        page, rest = ret[:page_size], ret[page_size:]
+        cursor = None
+        conn = self.get_connection()
+        if rest and conn:
+            cursor = uuid.uuid4().hex
+            is_recordset = isinstance(rest,models.Model)
+            conn.cursors.put(cursor,(user_id,model,rest.ids if is_recordset else list(rest),is_recordset,read_fields))
+        elif rest:
+            page = ret
+        with self._get_metrics().timer('firebase_stage_seconds', stage='serialize'):
+            if isinstance(page,models.Model):
+                page = page.read(read_fields)
+            page = [r.read(read_fields)[0] if isinstance(r,models.Model) else r for r in page]
+            chunks = encode_chunks(page,correlation_id,cursor,self.max_payload or MAX_PAYLOAD)
+        self._reply([{
+            'bridge_id': self.id,
+            'device': device,
+            'type': 'objects',
+            'model': model,
+            'data': chunk,
+        } for chunk in chunks])
+
+    def _send_error(self,device,model,correlation_id,error):
+        ''' Replies to a correlated request with a single error chunk'''
+        self._reply([{
+            'bridge_id': self.id,
+            'device': device,
+            'type': 'objects',
+            'model': model,
+            'data': encode_error(correlation_id,error),
+        }])
+
+    def _send_next_page(self,message):
+        ''' Sends the next page of a paginated response'''
+        data = message.data.get('data')
+        user_id = message.data.get('user_id')
+        conn = self.get_connection()
+        entry = conn and conn.cursors.pop(data.get('cursor'))
+        if not entry or entry[0] != user_id:
+            logger.warning('do_rpc (uid:%s): unknown or expired cursor %s' % (user_id,data.get('cursor')))
+            # Not an empty last page: the client must run its query again
+            self._send_error(message.data.get('from'),data.get('model'),data.get('id'),'cursor_expired')
+            return
+        user_id,model,rest,is_recordset,read_fields = entry
+        if is_recordset:
+            rest = self.env[model].with_user(user_id).browse(rest).exists()
+        self._send_response(message.data.get('from'),user_id,model,data.get('id'),rest,read_fields)
 
     def create_message(self, vals):
-        msg = self.env['firebase.message'].create(vals)
-        logger.debug('%s: created firebase message %s for %s (type:%s, model:%s)',self._name,msg.name,msg.partner_id,msg.type,msg.model)
+        return self.create_messages([vals])
+    
+    def create_messages(self, vals_list):
+        for vals in vals_list:
+            # Bridges only send their own messages
+            vals.setdefault('bridge_id', self.id)
+            if isinstance(vals.get('data'),str) and not vals.get('encoding'):
+                vals['data'], vals['encoding'] = compress(vals['data'],self.compress_threshold)
+        msgs = self.env['firebase.message'].create(vals_list)
+        for msg in msgs:
+            logger.debug('%s: created firebase message %s for %s (type:%s, model:%s)',self._name,msg.name,msg.partner_id,msg.type,msg.model)
+        return msgs
             
     def _oauth_authenticate(self,data):
         userid = self.env['res.users'].search(['&',['login','=',data.get('username')],['active','=',True]])
@@ -290,10 +1060,11 @@ class FirebaseBridge(models.Model):
             'partner_id': user.partner_id.id
         }
         message = {
+            'bridge_id': self.id,
             'device': session.device,
             'type': 'login-ack',
             'partner_id': user.partner_id.id,
-            'data': json.dumps(data, default=date_utils.json_default)
+            'data': dumps(data)
         }
         self.create_message(message)
         
@@ -357,37 +1128,229 @@ class FirebaseBridge(models.Model):
     def send_to_partner(self,partner_id,model,obj,notification=None):
         ''' Sends a message to all active sessions related to partner'''
         logger.debug('send_to_partner %s, %s, %s ' % (partner_id,model,obj))
+        self.send_to_partners([partner_id],model,obj,notification=notification)
+    
+    def send_to_partners(self,partner_ids,model,obj,notification=None,msg_type='object'):
+        ''' Sends one message to all active sessions of the partners.
+            Devices are resolved in one query when the message is sent'''
         if not isinstance(obj,str):
-            obj = json.dumps(obj, default=date_utils.json_default)
-            
-        msg = {
+            obj = dumps(obj)
+        partner_ids = list(partner_ids)
+        self.create_message({
             'bridge_id': self.id,
-            'type': 'object',
+            'type': msg_type,
             'model': model,
             'data': obj,
+            'partner_id': partner_ids[0] if len(partner_ids) == 1 else False,
+            'partner_ids': [(6, 0, partner_ids)],
+        })
+    
+    def send_delta(self,partner_id,model,values,full=False):
+        ''' Pushes record values to the partner's devices, sending only the 
+            fields changed since the last push as a 'delta' message:
+                {"id": res_id, "version": v, "base": v - 1, "values": {changed}}
+            A device whose version is not base must ask for a 'resync'.
+            Full pushes are 'object' messages, the version in __version.'''
+        PushState = self.env['firebase.push.state']
+        res_id = values['id']
+        payload = dumps(values)
+        # compare what the device got, not python values
+        current = json.loads(payload)
+        state = not full and PushState._get_state(self,partner_id,model,res_id)
+        if state:
+            version = state[0] + 1
+            changed = {k: v for k, v in current.items() if k not in state[1] or state[1][k] != v}
+            if not changed:
+                return
+            data = {'id': res_id, 'version': version, 'base': state[0], 'values': changed}
+            msg_type = 'delta'
+        else:
+            version = 1
+            data = dict(current, __version=version)
+            msg_type = 'object'
+        PushState._set_state(self,partner_id,model,res_id,version,current,payload)
+        self._push_record(partner_id,model,res_id,data,msg_type=msg_type)
+    
+    def _push_record(self,partner_id,model,res_id,data,msg_type='object'):
+        ''' Queues a push of a record to the partner's devices. 
+            Within the debounce interval, pushes of the same record are 
+            merged into the message still waiting to be sent'''
+        if not self.debounce_interval:
+            return self.send_to_partners([partner_id],model,data,msg_type=msg_type)
+        Message = self.env['firebase.message']
+        Message.flush(['bridge_id', 'partner_id', 'model', 'res_id', 'sent', 'send_after', 'state', 'attempts'])
+        self.env['firebase.message.recipient'].flush(['message_id', 'sent'])
+        # Only merge into a message never tried yet: some devices may have got
+        # a retried one already. Skip it if the bridge is sending it right now
+        self.env.cr.execute('''
+            SELECT id FROM firebase_message m
+             WHERE bridge_id = %s AND partner_id = %s AND model = %s AND res_id = %s
+               AND sent IS NULL AND send_after IS NOT NULL AND encoding IS NULL
+               AND state = 'queued' AND attempts = 0
+               AND NOT EXISTS (SELECT 1 FROM firebase_message_recipient r
+                                WHERE r.message_id = m.id AND r.sent IS NOT NULL)
+             ORDER BY id DESC LIMIT 1
+               FOR UPDATE SKIP LOCKED
+        ''', (self.id, partner_id, model, res_id))
+        row = self.env.cr.fetchone()
+        if row:
+            pending = Message.browse(row[0])
+            msg_type, data = self._merge_push(pending.type, json.loads(pending.data), msg_type, data)
+            pending.write({'type': msg_type, 'data': data if isinstance(data,str) else dumps(data)})
+            return
+        if not isinstance(data,str):
+            data = dumps(data)
+        self.create_message({
+            'bridge_id': self.id,
+            'type': msg_type,
+            'model': model,
+            'res_id': res_id,
+            'data': data,
             'partner_id': partner_id,
-            }
-        sessions = self.session_ids.filtered(lambda x: x.partner_id.id == partner_id and x.is_active == True)
-        for session in sessions:
-            logger.debug('send_to_partner device: %s' % session.device)
-            msg['device']=session.device
-            self.create_message(msg)
+            'partner_ids': [(6, 0, [partner_id])],
+            'send_after': fields.Datetime.now() + timedelta(seconds=self.debounce_interval),
+        })
+    
+    @api.model
+    def _merge_push(self,old_type,old_data,new_type,new_data):
+        ''' Merges a record push into a pending one. Returns (type, data)'''
+        if new_type != 'delta':
+            return new_type, new_data
+        if old_type == 'delta':
+            values = dict(old_data.get('values', {}), **new_data['values'])
+            return 'delta', dict(new_data, base=old_data.get('base'), values=values)
+        # full object, updated with the changes
+        return old_type, dict(old_data, __version=new_data['version'], **new_data['values'])
+    
+    def resync(self,message):
+        ''' A device reported a version mismatch: sends the record in full'''
+        data = message.data.get('data')
+        model, res_id = data.get('model'), int(data.get('res_id') or 0)
+        partner_id = message.data.get('partner_id')
+        self.env['firebase.push.state']._reset_state(self,partner_id,model,res_id)
+        record = self.env[model].with_user(message.data.get('user_id')).browse(res_id).exists()
+        if record and hasattr(record,'_firebase_send'):
+            record._firebase_send(partner_id,full=True)
+    
+    def send_to_devices(self,devices,model,obj):
+        ''' Sends one message to a list of devices'''
+        if not isinstance(obj,str):
+            obj = dumps(obj)
+        self.create_message({
+            'bridge_id': self.id,
+            'type': 'object',
+            'model': model,
+            'data': obj,
+            'recipient_ids': [(0, 0, {'device': device}) for device in devices],
+        })
+    
+    def send_to_topic(self,topic,model,obj):
+        ''' Publishes a message to the subscribers of an FCM topic'''
+        if not isinstance(obj,str):
+            obj = dumps(obj)
+        self.create_message({
+            'bridge_id': self.id,
+            'type': 'object',
+            'model': model,
+            'data': obj,
+            'topic': topic,
+        })
     
     @api.model
     def clean_start(self):
-        self.env['firebase.bridge'].search([]).write({'connected':False})
+        self.env['firebase.bridge'].search([]).write(self._get_pool_state_vals(None))
     
-    def check_sessions(self):
+    def check_sessions(self, limit=1000):
+        ''' Archives closed and expired sessions, at most limit per bridge'''
+        FirebaseSession = self.env['firebase.session']
         for record in self:
-            record.session_ids._compute_active()
+            cutoff = fields.Datetime.now() - timedelta(seconds=record.session_timeout)
+            expired = FirebaseSession.search([
+                ('bridge_id','=',record.id),
+                '|', '|', ('closed','=',True), ('last','=',False), ('last','<',cutoff),
+            ], limit=limit)
+            expired.write({'active': False})
+            logger.debug('Firebase Bridge %s: archived %s sessions', record.id, len(expired))
         return True
     
+    @api.model
+    def _cron_check_sessions(self, limit=1000):
+        self.search([]).check_sessions(limit=limit)
+    
     def ping_sessions(self):
+        ''' Pings the idle sessions that are due, at most ping_batch per bridge'''
         for record in self:
-            for s in record.session_ids.filtered(lambda x: x.is_active):
-                # print("_ping_sessions",(fields.Datetime.now() - s.last).total_seconds(),record.session_timeout/2)
-                if (fields.Datetime.now() - s.last).total_seconds() > record.session_timeout/2:
-                    s.ping()
+            conn = record.get_connection()
+            if conn:
+                record._ping_due(conn)
+            else:
+                # Bridge running in another process: queue ping messages
+                session_ids = [sid for sid, _device in record._claim_due_sessions()]
+                record.env['firebase.session'].browse(session_ids).ping()
         return True
+    
+    def _claim_due_sessions(self):
+        ''' Schedules the next ping of the active sessions idle for more 
+            than half the timeout whose ping is due, and returns (id, device)
+            of those to ping now. Rows are only locked by this statement.
+            Sessions becoming idle get their first ping a random time within
+            the next quarter of the timeout, so they do not come in bursts 
+            either, see _schedule_pings'''
+        self.env['firebase.session'].flush(['bridge_id', 'active', 'closed', 'last', 'next_ping'])
+        now = fields.Datetime.now()
+        quarter = self.session_timeout/4
+        self.env.cr.execute('''
+            WITH due AS (
+                SELECT id, next_ping IS NULL AS first FROM firebase_session
+                 WHERE bridge_id = %s AND active = true AND closed IS NOT TRUE
+                   AND last >= %s AND last < %s
+                   AND (next_ping IS NULL OR next_ping <= %s)
+                 ORDER BY next_ping NULLS FIRST
+                 LIMIT %s
+                   FOR UPDATE SKIP LOCKED)
+            UPDATE firebase_session s
+               SET next_ping = now() at time zone 'UTC' + interval '1 second' *
+                   CASE WHEN due.first THEN random() * %s ELSE %s + random() * %s END
+              FROM due
+             WHERE s.id = due.id
+         RETURNING s.id, s.device, due.first
+        ''', (self.id, now - timedelta(seconds=self.session_timeout),
+              now - timedelta(seconds=self.session_timeout/2), now, self.ping_batch or 500,
+              quarter, quarter, quarter))
+        rows = self.env.cr.fetchall()
+        self.env['firebase.session'].invalidate_cache(['next_ping'], [sid for sid, _device, _first in rows])
+        return [(sid, device) for sid, device, first in rows if not first]
+    
+    def _schedule_pings(self, session_ids):
+        ''' Next ping in a quarter to half the timeout, at random, so pings
+            spread over the window instead of coming in bursts'''
+        if session_ids:
+            self.env['firebase.session'].invalidate_cache(['next_ping'], session_ids)
+            self.env.cr.execute('''
+                UPDATE firebase_session
+                   SET next_ping = now() at time zone 'UTC' + interval '1 second' * (%s + random() * %s)
+                 WHERE id IN %s
+            ''', (self.session_timeout/4, self.session_timeout/4, tuple(session_ids)))
+    
+    @cursored
+    def _ping_round(self, conn):
+        self._ping_due(conn)
+    
+    def _ping_due(self, conn):
+        ''' Pings due sessions straight on the XMPP connection, without
+            storing ping messages. Sessions are claimed and committed first,
+            so no row stays locked while sending'''
+        due = self._claim_due_sessions()
+        self.env.cr.commit()
+        if not due:
+            return
+        failed = runner.call(conn.send_batch([(sid, [device], PING, {}) for sid, device in due]))
+        if failed:
+            # Due again on the next round
+            self.env['firebase.session'].invalidate_cache(['next_ping'], failed)
+            self.env.cr.execute('''
+                UPDATE firebase_session SET next_ping = now() at time zone 'UTC' WHERE id IN %s
+            ''', (tuple(failed),))
+        logger.debug('Firebase Bridge %s: pinged %s sessions', self.id, len(due) - len(failed))
 
 
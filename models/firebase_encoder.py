@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import logging
+import zlib
+
+from odoo.tools import config, date_utils
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# FCM rejects data payloads over 4KB. Leave room for the message envelope
+# (type, model, FCM options). Sizes are UTF-8 bytes, see size()
+MAX_PAYLOAD = 3500
+
+# Value of the 'encoding' key of compressed message data
+ZLIB_BASE64 = 'zlib+base64'
+
+
+def json_dumps(obj):
+    return json.dumps(obj, default=date_utils.json_default)
+
+
+def orjson_dumps(obj):
+    try:
+        # Dates go through json_default, to keep Odoo's string format
+        return orjson.dumps(obj, default=date_utils.json_default,
+                            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS).decode()
+    except TypeError:
+        # e.g. integers over 64 bits
+        return json_dumps(obj)
+
+
+# Available serializers, selected with the firebase_encoder config option.
+# Other modules may register their own.
+ENCODERS = {
+    'json': json_dumps,
+}
+if orjson:
+    ENCODERS['orjson'] = orjson_dumps
+
+
+def dumps(obj):
+    ''' Serializes obj to a JSON string with the configured encoder.
+        Defaults to orjson when available'''
+    name = config.get('firebase_encoder') or ('orjson' if orjson else 'json')
+    encoder = ENCODERS.get(name)
+    if not encoder:
+        logger.warning('Unknown firebase_encoder %s, using json', name)
+        encoder = ENCODERS[name] = json_dumps
+    return encoder(obj)
+
+
+def size(text):
+    ''' Size of text on the wire: encoders write raw UTF-8'''
+    return len(text.encode())
+
+
+def compress(text, threshold):
+    ''' Compresses text longer than threshold bytes (0 disables it).
+        Returns (text, encoding), encoding being None if left as is'''
+    if not threshold or size(text) <= threshold:
+        return text, None
+    packed = base64.b64encode(zlib.compress(text.encode())).decode()
+    if len(packed) >= size(text):
+        return text, None
+    return packed, ZLIB_BASE64
+
+
+def _header(correlation_id, seq, total, cursor):
+    return '"id": %s, "seq": %d, "total": %d, "cursor": %s' % (
+        dumps(correlation_id), seq, total, dumps(cursor))
+
+
+def _fragments(text, budget):
+    ''' Splits text into pieces whose JSON string encoding fits in budget
+        bytes'''
+    pieces = []
+    while text:
+        length = budget
+        encoded = dumps(text[:length])
+        while size(encoded) > budget and length > 1:
+            # escaping and multi-byte characters make the encoding longer
+            # than the piece itself
+            length = max(1, min(length - 1, length * budget // size(encoded)))
+            encoded = dumps(text[:length])
+        pieces.append(encoded)
+        text = text[length:]
+    return pieces
+
+
+def encode_chunks(records, correlation_id, cursor=None, max_size=MAX_PAYLOAD):
+    ''' Packs records into JSON chunks of at most max_size UTF-8 bytes, so a client
+        can reassemble them by correlation id. Every chunk has:
+            id: the request correlation id
+            seq, total: position of the chunk (0 based) and number of chunks
+            cursor: token to fetch the next page, or null if this is the last one
+        and either
+            records: a list of records, or
+            fragment, more: a piece of the JSON of a record too large for a
+                chunk on its own. Fragments are concatenated until more is false.
+        Returns the list of chunk strings'''
+    # Worst case header size, whatever seq and total end up being
+    overhead = size(_header(correlation_id, 10 ** 9, 10 ** 9, cursor)) + len('{, "records": []}')
+    budget = max(max_size - overhead, 64)
+
+    bodies = []
+    packed, used = [], 0
+    for record in records:
+        text = dumps(record)
+        length = size(text)
+        if packed and used + 2 + length > budget:
+            bodies.append('"records": [%s]' % ', '.join(packed))
+            packed, used = [], 0
+        if length <= budget:
+            used += length + (2 if packed else 0)
+            packed.append(text)
+            continue
+        # Record alone is too big: split it in fragments
+        pieces = _fragments(text, budget - len(', "more": false, "fragment": '))
+        for i, piece in enumerate(pieces):
+            bodies.append('"fragment": %s, "more": %s' % (piece, 'true' if i < len(pieces) - 1 else 'false'))
+    if packed or not bodies:
+        bodies.append('"records": [%s]' % ', '.join(packed))
+
+    total = len(bodies)
+    return ['{%s, %s}' % (_header(correlation_id, seq, total, cursor), body)
+            for seq, body in enumerate(bodies)]
+
+
+def encode_error(correlation_id, error):
+    ''' Single final chunk reporting that the request failed: no records, 
+        and an error code instead'''
+    return '{%s, "error": %s, "records": []}' % (_header(correlation_id, 0, 1, None), dumps(error))
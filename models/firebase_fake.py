@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+
+from xmppgcm import XMPPEvent
+
+logger = logging.getLogger(__name__)
+
+
+class FakeMessage(object):
+    ''' Inbound message, shaped like the ones xmppgcm hands to handlers'''
+
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeFCM(object):
+    ''' In-process stand-in for the FCM XMPP endpoint, shared by every
+        FakeGCM client of the process. Behaviour is driven by attributes and
+        methods, callable from any thread:
+            ack_delay: seconds before a message is ACKed
+            nack_ratio, nack_error: share of messages NACKed, and error code
+            throttle(): holds ACKs until release()
+            drain(): announces CONNECTION_DRAINING on every stream, and closes
+                them drain_delay seconds later
+            disconnect(): drops every stream
+            inject(device, data): upstream message from a device
+        Outbound messages are reported to listeners as
+        listener(device, data, options, time.monotonic())'''
+
+    def __init__(self):
+        self.clients = []
+        self.listeners = []
+        self.ack_delay = 0.0
+        self.nack_ratio = 0.0
+        self.nack_error = 'SERVICE_UNAVAILABLE'
+        self.drain_delay = 1.0
+        self.connect_delay = 0.0
+        self.throttled = False
+        self.held = []  # ACK callbacks held while throttled
+        self.stats = defaultdict(int)
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def reset(self):
+        ''' Back to immediate ACKs, without listeners'''
+        self.listeners = []
+        self.ack_delay = 0.0
+        self.nack_ratio = 0.0
+        self.nack_error = 'SERVICE_UNAVAILABLE'
+        self.stats.clear()
+        self.release()
+
+    def _connected(self):
+        return [c for c in self.clients if c.connected]
+
+    def throttle(self):
+        self.throttled = True
+
+    def release(self):
+        self.throttled = False
+        with self._lock:
+            held, self.held = self.held, []
+        for client, cb, data in held:
+            client.loop.call_soon_threadsafe(cb, data)
+
+    def drain(self):
+        for client in self._connected():
+            client.loop.call_soon_threadsafe(client._drain, self.drain_delay)
+
+    def disconnect(self):
+        for client in self._connected():
+            client.loop.call_soon_threadsafe(client._close)
+
+    def inject(self, device, data):
+        ''' Delivers data as an upstream message of device, on a connected
+            stream picked at random. Returns False if none is connected'''
+        clients = self._connected()
+        if not clients:
+            return False
+        client = random.choice(clients)
+        message = FakeMessage({
+            'from': device,
+            'message_id': 'up-%s' % next(self._ids),
+            'data': dict(data),
+        })
+        self.stats['inbound'] += 1
+        client.loop.call_soon_threadsafe(client._fire, XMPPEvent.MESSAGE, message)
+        return True
+
+    def _receive(self, client, to, data, options, cb):
+        ''' Called by clients for every downstream message'''
+        now = time.monotonic()
+        self.stats['outbound'] += 1
+        for listener in list(self.listeners):
+            try:
+                listener(to, data, options, now)
+            except Exception:
+                logger.exception('Fake FCM listener failed')
+        if not cb:
+            return
+        message_id = 'down-%s' % next(self._ids)
+        if self.nack_ratio and random.random() < self.nack_ratio:
+            self.stats['nacks'] += 1
+            ack = {'message_type': 'nack', 'from': to, 'message_id': message_id, 'error': self.nack_error}
+        else:
+            self.stats['acks'] += 1
+            ack = {'message_type': 'ack', 'from': to, 'message_id': message_id}
+        if self.throttled:
+            with self._lock:
+                self.held.append((client, cb, ack))
+        elif self.ack_delay:
+            client.loop.call_later(self.ack_delay, cb, ack)
+        else:
+            client.loop.call_soon(cb, ack)
+
+
+fake_fcm = FakeFCM()
+
+
+class FakeGCM(object):
+    ''' xmppgcm.GCM replacement talking to fake_fcm. Must be created and
+        used from the event loop running the bridge'''
+
+    def __init__(self, jid, password, server=None):
+        self.jid = jid
+        self.server = server or fake_fcm
+        self.loop = asyncio.get_event_loop()
+        self.handlers = defaultdict(list)
+        self.connected = False
+        self.default_port = None
+        self.server.clients.append(self)
+
+    def add_event_handler(self, event, handler):
+        self.handlers[event].append(handler)
+
+    def _fire(self, event, *args):
+        for handler in self.handlers[event]:
+            handler(*args)
+
+    def connect(self, address=None, use_ssl=True):
+        self.loop.call_later(self.server.connect_delay, self._open)
+
+    def _open(self):
+        if not self.connected:
+            self.connected = True
+            self._fire(XMPPEvent.CONNECTED, 0)
+
+    def _drain(self, delay):
+        if self.connected:
+            self._fire(XMPPEvent.DISCONNECTED, True)
+            self.loop.call_later(delay, self._close)
+
+    def _close(self):
+        if self.connected:
+            self.connected = False
+            self._fire(XMPPEvent.DISCONNECTED, False)
+
+    def disconnect(self, wait=0.0):
+        self._close()
+        if self in self.server.clients:
+            self.server.clients.remove(self)
+
+    def send_gcm(self, to, data, options=None, cb=None):
+        if not self.connected:
+            raise ConnectionError('Fake FCM stream is not connected')
+        self.server._receive(self, to, data, options, cb)
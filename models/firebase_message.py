@@ -1,41 +1,179 @@
 import logging
 import json
+import uuid
 from odoo import _, api, models, fields
 from odoo.tools import date_utils
+from .firebase_runner import NOTIFY_CHANNEL
 
 logger = logging.getLogger(__name__)
+
+# NACK errors worth retrying, see
+# https://firebase.google.com/docs/cloud-messaging/xmpp-server-ref#nack-messages
+# ACK_TIMEOUT, CONNECTION_LOST and SEND_ERROR are reported by the bridge itself
+RETRY_ERRORS = {
+    'SERVICE_UNAVAILABLE', 'INTERNAL_SERVER_ERROR', 'CONNECTION_DRAINING',
+    'DEVICE_MESSAGE_RATE_EXCEEDED', 'TOPICS_MESSAGE_RATE_EXCEEDED',
+    'ACK_TIMEOUT', 'CONNECTION_LOST', 'SEND_ERROR',
+}
+# NACK errors meaning the device token is no longer valid
+INVALID_TOKEN_ERRORS = {'BAD_REGISTRATION', 'DEVICE_UNREGISTERED'}
+# Retry delays: BACKOFF_BASE * 2^attempts seconds, capped to BACKOFF_MAX, +-50% jitter
+BACKOFF_BASE = 2
+BACKOFF_MAX = 600
+
+STATES = [
+    ('queued', 'Queued'),
+    ('sent', 'Sent'),
+    ('delivered', 'Delivered'),
+    ('failed', 'Failed'),
+]
+
 class FirebaseMessage(models.Model):
     _name = 'firebase.message'
     _description = 'Firebase Message'
     
     name = fields.Char(
         string="Name",
-        required=True,
         index=True,
         copy=False,
-        default=lambda self: _("New"),
     )
     bridge_id = fields.Many2one('firebase.bridge', _('Firebase Bridge') )
     partner_id = fields.Many2one('res.partner', _('Partner') )
+    partner_ids = fields.Many2many('res.partner', 'firebase_message_partner_rel', 'message_id', 'partner_id', string=_('Partners'))
     device = fields.Char(_('Device ID'))
+    topic = fields.Char(_('Topic'), help=_('FCM topic the message is published to'))
+    recipient_ids = fields.One2many('firebase.message.recipient', 'message_id', string=_('Recipients'))
     type = fields.Char(_('Message type'))
     model = fields.Char(_('Model'))
+    res_id = fields.Integer(_('Record ID'), help=_('Record pushed, for debounced record pushes'))
     data = fields.Text(_('Message content'))
+    encoding = fields.Char(_('Data encoding'), help=_('Set if data is compressed (zlib+base64)'))
     created = fields.Datetime(_('Created'), default=fields.Datetime.now, required=True)
+    send_after = fields.Datetime(_('Send after'), help=_('Debounced messages wait until this time'))
     sent = fields.Datetime(_('Sent'))
+    state = fields.Selection(STATES, string=_('State'), default='queued', index=True)
+    acked = fields.Datetime(_('Acknowledged'))
+    error = fields.Char(_('Last error'))
+    attempts = fields.Integer(_('Failed attempts'), default=0)
     
-    @api.model
+    def init(self):
+        # Pending queue access path used by firebase.bridge._get_messages
+        self.env.cr.execute('''
+            CREATE INDEX IF NOT EXISTS firebase_message_pending_idx
+                ON firebase_message (bridge_id, created, id)
+             WHERE sent IS NULL
+        ''')
+        # Purge of sent messages, see firebase.retention
+        self.env.cr.execute('''
+            CREATE INDEX IF NOT EXISTS firebase_message_sent_idx
+                ON firebase_message (type, sent)
+             WHERE sent IS NOT NULL
+        ''')
+        # Debounced record pushes still waiting, see firebase.bridge._push_record
+        self.env.cr.execute('''
+            CREATE INDEX IF NOT EXISTS firebase_message_debounce_idx
+                ON firebase_message (bridge_id, partner_id, model, res_id)
+             WHERE sent IS NULL AND send_after IS NOT NULL
+        ''')
+    
+    # Message types that are not worth naming
+    _ephemeral_types = ('ping',)
+    
+    @api.model_create_multi
     def create(self, vals_list):
-        if vals_list.get("name", _("New")) == _("New"):
-            vals_list["name"] = self.env["ir.sequence"].next_by_code(
-                "firebase.message") or _("New")
+        name_ephemeral = self.env.context.get('firebase_name_ephemeral')
+        for vals in vals_list:
+            if vals.get('name', _('New')) == _('New'):
+                if vals.get('type') in self._ephemeral_types and not name_ephemeral:
+                    vals['name'] = False
+                else:
+                    vals['name'] = self._new_name()
         ret = super(FirebaseMessage, self).create(vals_list)
+        ret._notify_bridge()
         return ret
     
+    @api.model
+    def _new_name(self):
+        ''' Unique message name, without touching the database'''
+        return 'FBM%s' % uuid.uuid4().hex[:16].upper()
+    
+    def _get_destinations(self):
+        ''' Returns the pending (recipient, to) destinations of the message.
+            Partner targets are expanded into recipients on first call, 
+            with the devices of their active sessions.'''
+        self.ensure_one()
+        Recipient = self.env['firebase.message.recipient']
+        if self.topic:
+            return [(Recipient, '/topics/%s' % self.topic)]
+        if self.device:
+            return [(Recipient, self.device)]
+        partners = self.partner_ids | self.partner_id
+        if not self.recipient_ids and partners and self.bridge_id:
+            sessions = self.bridge_id._get_active_sessions(partners.ids)
+            Recipient.create([{
+                'message_id': self.id,
+                'device': s.device,
+                'partner_id': s.partner_id.id,
+            } for s in sessions])
+        return [(r, r.device) for r in self.recipient_ids if not r.sent]
+    
+    def _retry(self, error, max_attempts):
+        ''' Counts a failed delivery attempt. Messages are queued again with
+            an exponential backoff, or fail after max_attempts'''
+        if not self:
+            return
+        self.flush(['attempts', 'sent', 'state', 'error', 'send_after'])
+        self.env.cr.execute('''
+            UPDATE firebase_message
+               SET attempts = attempts + 1, error = %s,
+                   state = CASE WHEN attempts + 1 >= %s THEN 'failed' ELSE 'queued' END,
+                   sent = CASE WHEN attempts + 1 >= %s THEN now() at time zone 'UTC' ELSE NULL END,
+                   send_after = now() at time zone 'UTC'
+                       + interval '1 second' * least(%s * power(2, attempts), %s) * (0.5 + random())
+             WHERE id IN %s
+        ''', (error, max_attempts, max_attempts, BACKOFF_BASE, BACKOFF_MAX, tuple(self.ids)))
+        self.invalidate_cache(['attempts', 'sent', 'state', 'error', 'send_after'], self.ids)
+    
+    def _requeue(self, attempts):
+        ''' Queues multicast messages again for their recipients to retry, 
+            with the backoff of attempts failed attempts. Attempts are 
+            counted by the recipients, not here'''
+        if not self:
+            return
+        self.flush(['sent', 'state', 'send_after'])
+        self.env.cr.execute('''
+            UPDATE firebase_message
+               SET state = 'queued', sent = NULL,
+                   send_after = now() at time zone 'UTC'
+                       + interval '1 second' * least(%s * power(2, %s - 1), %s) * (0.5 + random())
+             WHERE id IN %s
+        ''', (BACKOFF_BASE, max(attempts, 1), BACKOFF_MAX, tuple(self.ids)))
+        self.invalidate_cache(['sent', 'state', 'send_after'], self.ids)
+    
+    def _update_delivered(self):
+        ''' Marks delivered the multicast messages with no recipient left
+            waiting'''
+        if not self:
+            return
+        self.env['firebase.message.recipient'].flush(['message_id', 'state'])
+        self.env.cr.execute('''
+            UPDATE firebase_message m
+               SET state = 'delivered', acked = now() at time zone 'UTC'
+             WHERE m.id IN %s AND m.state = 'sent'
+               AND NOT EXISTS (SELECT 1 FROM firebase_message_recipient r
+                                WHERE r.message_id = m.id
+                                  AND r.state NOT IN ('delivered', 'failed'))
+        ''', (tuple(self.ids),))
+        self.invalidate_cache(['state', 'acked'], self.ids)
+    
+    def _notify_bridge(self):
+        ''' Wakes up bridge threads listening for new messages. 
+            PostgreSQL delivers the notification on commit, and collapses 
+            duplicates within the same transaction.'''
+        for bridge_id in set(self.mapped('bridge_id').ids) or {0}:
+            self.env.cr.execute('NOTIFY %s, %%s' % NOTIFY_CHANNEL, (str(bridge_id),))
+    
     @api.model
     def _cron_delete_old_pings(self, max=10000):
-        pings = self.search(['&',('type','=','ping'),('sent','!=',None)],limit=max)
-        pings_found = len(pings)
-        pings.unlink()
-        pings_left = self.search_count(['&',('type','=','ping'),('sent','!=',None)])
-        logger.info('Pings deleted:%s. left:%s',pings_found,pings_left)
+        ''' Deprecated: see firebase.retention'''
+        self.env['firebase.retention']._cron_purge(batch=max)
@@ -0,0 +1,46 @@
+from odoo import _, models, fields
+
+from .firebase_message import STATES
+
+
+class FirebaseMessageRecipient(models.Model):
+    ''' Delivery of a multicast firebase.message to one device'''
+    _name = 'firebase.message.recipient'
+    _description = 'Firebase Message Recipient'
+    _rec_name = 'device'
+
+    message_id = fields.Many2one('firebase.message', _('Message'), required=True, index=True, ondelete='cascade')
+    device = fields.Char(_('Device ID'), required=True)
+    partner_id = fields.Many2one('res.partner', _('Partner'))
+    sent = fields.Datetime(_('Sent'))
+    state = fields.Selection(STATES, string=_('State'), default='queued')
+    acked = fields.Datetime(_('Acknowledged'))
+    error = fields.Char(_('Last error'))
+    attempts = fields.Integer(_('Failed attempts'), default=0)
+
+    def _retry(self, error, max_attempts):
+        ''' Counts a failed delivery attempt. Recipients are sent again with
+            their message, which is queued with a backoff, or fail after 
+            max_attempts. The limit applies to each recipient only'''
+        if not self:
+            return
+        self.flush(['attempts', 'sent', 'state', 'error'])
+        self.env.cr.execute('''
+            UPDATE firebase_message_recipient
+               SET attempts = attempts + 1, error = %s,
+                   state = CASE WHEN attempts + 1 >= %s THEN 'failed' ELSE 'queued' END,
+                   sent = CASE WHEN attempts + 1 >= %s THEN now() at time zone 'UTC' ELSE NULL END
+             WHERE id IN %s
+         RETURNING message_id, state, attempts
+        ''', (error, max_attempts, max_attempts, tuple(self.ids)))
+        rows = self.env.cr.fetchall()
+        self.invalidate_cache(['attempts', 'sent', 'state', 'error'], self.ids)
+        Message = self.env['firebase.message']
+        # Backoff of the most tried recipient still queued
+        requeue = {}
+        for message_id, state, attempts in rows:
+            if state == 'queued':
+                requeue[message_id] = max(requeue.get(message_id, 0), attempts)
+        for attempts in set(requeue.values()):
+            Message.browse([m for m, a in requeue.items() if a == attempts])._requeue(attempts)
+        Message.browse({m for m, _state, _attempts in rows})._update_delivered()
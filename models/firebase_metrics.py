@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import bisect
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+# Metric name -> (type, help), in Prometheus text format terms
+METRICS = {
+    'firebase_batches_total': ('counter', 'Outbound message batches processed'),
+    'firebase_messages_sent_total': ('counter', 'Messages handed to FCM'),
+    'firebase_messages_failed_total': ('counter', 'Messages that could not be handed to FCM'),
+    'firebase_acks_total': ('counter', 'ACK/NACK received from FCM, by result'),
+    'firebase_nacks_total': ('counter', 'NACK received from FCM, by error code'),
+    'firebase_reconnects_total': ('counter', 'Reconnection attempts of the XMPP streams'),
+    'firebase_auth_cache_total': ('counter', 'Session key checks, by session cache result'),
+    'firebase_rpc_errors_total': ('counter', 'RPC calls raising an exception, by model and method'),
+    'firebase_rpc_readonly_total': ('counter', 'Inbound RPC and batch messages run on the read-only path'),
+    'firebase_read_cache_total': ('counter', 'Read RPCs, by result cache result'),
+    'firebase_message_age_seconds': ('histogram', 'Time from message creation to hand-off to FCM'),
+    'firebase_stage_seconds': ('histogram', 'Duration of the bridge hot path stages'),
+    'firebase_rpc_seconds': ('histogram', 'RPC execution time, by model and method'),
+    'firebase_commit_seconds': ('histogram', 'Commit time of the bridge jobs, by job'),
+    'firebase_queue_depth': ('gauge', 'Messages waiting to be sent'),
+    'firebase_inflight': ('gauge', 'Messages waiting for their ACK'),
+    'firebase_rpc_pending': ('gauge', 'Inbound messages waiting for an RPC worker'),
+    'firebase_connections_up': ('gauge', 'Healthy XMPP streams of the pool'),
+}
+
+
+class Histogram(object):
+    ''' Cumulative histogram over BUCKETS. Thread-safe'''
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def quantile(self, q):
+        ''' Upper bound of the bucket holding the q quantile, None if empty'''
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+
+class Metrics(object):
+    ''' Counters and histograms of a bridge, labelled by keyword. Thread-safe'''
+
+    def __init__(self):
+        self.counters = Counter()  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def snapshot(self):
+        ''' Copies of the counters and histograms, safe to iterate'''
+        with self._lock:
+            return dict(self.counters), dict(self.histograms)
+
+    def value(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+
+# (dbname, bridge_id) -> Metrics. Kept across reconnections, so counters
+# only grow for the life of the process
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_metrics(dbname, bridge_id):
+    metrics = _registry.get((dbname, bridge_id))
+    if metrics is None:
+        with _registry_lock:
+            metrics = _registry.setdefault((dbname, bridge_id), Metrics())
+    return metrics
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(samples):
+    ''' Renders metrics in Prometheus text exposition format.
+        samples are (bridge_id, metrics, gauges) tuples, gauges being a
+        dict of gauge name -> value'''
+    lines = {name: [] for name in METRICS}
+    for bridge_id, metrics, gauges in samples:
+        base = (('bridge', bridge_id),)
+        for name, value in gauges.items():
+            lines.setdefault(name, []).append('%s%s %s' % (name, _format_labels(base), _format_value(value)))
+        if metrics is None:
+            continue
+        counters, histograms = metrics.snapshot()
+        for (name, labels), value in sorted(counters.items()):
+            lines.setdefault(name, []).append('%s%s %s' % (name, _format_labels(base + labels), _format_value(value)))
+        for (name, labels), histogram in sorted(histograms.items(), key=lambda i: i[0]):
+            out = lines.setdefault(name, [])
+            counts, total, count = histogram.snapshot()
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS + (float('inf'),), counts):
+                cumulative += bucket
+                out.append('%s_bucket%s %s' % (name, _format_labels(base + labels + (('le', _format_value(bound)),)), cumulative))
+            out.append('%s_sum%s %s' % (name, _format_labels(base + labels), _format_value(total)))
+            out.append('%s_count%s %s' % (name, _format_labels(base + labels), count))
+    text = []
+    for name, out in lines.items():
+        if not out:
+            continue
+        kind, doc = METRICS.get(name, ('untyped', ''))
+        text.append('# HELP %s %s' % (name, doc))
+        text.append('# TYPE %s %s' % (name, kind))
+        text.extend(out)
+    return '\n'.join(text) + '\n'
@@ -1,27 +1,58 @@
-import json
 from odoo import _, api, models, fields
-from odoo.tools import date_utils
 import logging
 
+from .firebase_encoder import dumps
+
 logger = logging.getLogger(__name__)
 class FirebaseMixin(models.AbstractModel):
     _name = 'firebase.mixin'
     _description = "mixin to send"
     
+    # Default fields sent, when no firebase.projection is configured (None: all)
+    _firebase_fields = None
+    
     def _to_firebase_data(self):
-        return json.dumps(self.read()[0], default=date_utils.json_default)
+        read_fields = self.env['firebase.projection']._project(self._name)
+        return dumps(self.read(read_fields)[0])
     
-    def _firebase_send(self,partner_id, ev=None):
-        ev = ev or self._to_firebase_data()
+    def _firebase_send(self,partner_id, ev=None, full=False):
+        ''' Queues a push of the records to the partner's devices. 
+            Pushes of the same record are coalesced until the transaction 
+            commits, when only its final state is sent'''
         bridge = self._get_default_bridge()
-        if bridge and bridge.connected :
-            bridge.send_to_partner(partner_id,self._name,ev)
+        if not (bridge and bridge.connected):
+            return
+        outbound = self.env.cr.precommit.data.setdefault('firebase.outbound', {})
+        if not outbound:
+            self.env.cr.precommit.add(self._firebase_flush_outbound)
+        for record in self:
+            key = (partner_id, record._name, record.id)
+            previous = outbound.pop(key, None)
+            outbound[key] = (record, ev, full or bool(previous and previous[2]))
+    
+    def _firebase_flush_outbound(self):
+        ''' Pre-commit hook sending the pushes queued by _firebase_send'''
+        outbound = self.env.cr.precommit.data.pop('firebase.outbound', {})
+        for (partner_id, _model, _res_id), (record, ev, full) in outbound.items():
+            if record.exists():
+                record._firebase_push(partner_id, ev=ev, full=full)
+        # Hooks run after the ORM flush that precedes commit
+        self.env['base'].flush()
+    
+    def _firebase_push(self,partner_id, ev=None, full=False):
+        ''' Sends the record to the partner's devices right away'''
+        bridge = self._get_default_bridge()
+        if bridge.delta_push and not ev:
+            read_fields = self.env['firebase.projection']._project(self._name)
+            bridge.send_delta(partner_id,self._name,self.read(read_fields)[0],full=full)
+            return
+        ev = ev or self._to_firebase_data()
+        bridge._push_record(partner_id,self._name,self.id,ev)
 
     @api.model        
     def _firebase_is_active(self,partner_id):
         bridge = self._get_default_bridge()
-        sessions = bridge.session_ids.filtered(lambda x: x.partner_id.id == partner_id)
-        return any(s.is_active for s in sessions)
+        return bool(bridge._get_active_sessions([partner_id], limit=1))
     
     @api.model
     def _get_default_bridge(self):
@@ -0,0 +1,50 @@
+from odoo import _, api, models, fields, tools
+
+
+class FirebaseProjection(models.Model):
+    ''' Whitelist of the fields of a model sent through Firebase'''
+    _name = 'firebase.projection'
+    _description = 'Firebase model field whitelist'
+    _rec_name = 'model_id'
+
+    model_id = fields.Many2one('ir.model', _('Model'), required=True, index=True, ondelete='cascade')
+    model = fields.Char(related='model_id.model', store=True, index=True)
+    field_ids = fields.Many2many('ir.model.fields', string=_('Fields'), domain="[('model_id','=',model_id)]")
+
+    _sql_constraints = [
+        ('model_uniq', 'unique(model_id)', 'There can be only one field whitelist per model'),
+    ]
+
+    @api.model
+    @tools.ormcache('model')
+    def _get_fields(self, model):
+        ''' Whitelisted field names of model, or None if unrestricted.
+            Models may also declare a _firebase_fields default'''
+        projection = self.sudo().search([('model', '=', model)], limit=1)
+        if projection:
+            return tuple(projection.field_ids.mapped('name'))
+        default = getattr(self.env[model], '_firebase_fields', None) if model in self.env else None
+        return tuple(default) if default is not None else None
+
+    @api.model
+    def _project(self, model, requested=None):
+        ''' Fields to read from model: requested ones (all if None) restricted
+            to the whitelist. Returns None to read all fields'''
+        allowed = self._get_fields(model)
+        if allowed is None:
+            return list(requested) if requested else None
+        projected = [f for f in (requested or allowed) if f in allowed]
+        return projected or ['id']
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.clear_caches()
+        return super(FirebaseProjection, self).create(vals_list)
+
+    def write(self, vals):
+        self.clear_caches()
+        return super(FirebaseProjection, self).write(vals)
+
+    def unlink(self):
+        self.clear_caches()
+        return super(FirebaseProjection, self).unlink()
@@ -0,0 +1,77 @@
+import json
+
+from odoo import _, api, models, fields
+
+from .firebase_runner import TTLCache
+
+# Last pushed (version, values) per (db, bridge, partner, model, res_id),
+# shared by all environments of the process
+_states = TTLCache(24 * 3600, 10000)
+
+
+class FirebasePushState(models.Model):
+    ''' Last version of a record pushed to a partner's devices, used to 
+        compute delta pushes. Persisted only if the bridge asks for it, 
+        an in-memory LRU cache is used otherwise (and written through when
+        persisted)'''
+    _name = 'firebase.push.state'
+    _description = 'Firebase delta push state'
+
+    bridge_id = fields.Many2one('firebase.bridge', _('Firebase Bridge'), required=True, ondelete='cascade')
+    partner_id = fields.Many2one('res.partner', _('Partner'), required=True, ondelete='cascade')
+    model = fields.Char(_('Model'), required=True)
+    res_id = fields.Integer(_('Record ID'), required=True)
+    version = fields.Integer(_('Version'), required=True)
+    payload = fields.Text(_('Last values'))
+
+    _sql_constraints = [
+        ('record_uniq', 'unique(bridge_id, partner_id, model, res_id)', 'Duplicated push state'),
+    ]
+
+    @api.model
+    def _get_state(self, bridge, partner_id, model, res_id):
+        ''' Returns (version, values) last pushed, or None.
+            Persisted states are always read from the database, locking the
+            row until the transaction ends so that concurrent pushes of the
+            record get consecutive versions: other workers may have pushed
+            since this process cached it'''
+        key = (self.env.cr.dbname, bridge.id, partner_id, model, res_id)
+        if not bridge.delta_persistent:
+            return _states.get(key)
+        self.env.cr.execute('''
+            SELECT version, payload FROM firebase_push_state
+             WHERE bridge_id = %s AND partner_id = %s AND model = %s AND res_id = %s
+               FOR UPDATE
+        ''', (bridge.id, partner_id, model, res_id))
+        row = self.env.cr.fetchone()
+        if not row:
+            _states.pop(key)
+            return None
+        state = (row[0], json.loads(row[1] or '{}'))
+        _states.put(key, state)
+        return state
+
+    @api.model
+    def _set_state(self, bridge, partner_id, model, res_id, version, values, payload):
+        ''' Records values (serialized as payload) as the last pushed version'''
+        _states.put((self.env.cr.dbname, bridge.id, partner_id, model, res_id), (version, values))
+        if bridge.delta_persistent:
+            self.env.cr.execute('''
+                INSERT INTO firebase_push_state
+                       (bridge_id, partner_id, model, res_id, version, payload,
+                        create_uid, create_date, write_uid, write_date)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')
+                ON CONFLICT (bridge_id, partner_id, model, res_id)
+                DO UPDATE SET version = EXCLUDED.version, payload = EXCLUDED.payload,
+                              write_uid = EXCLUDED.write_uid, write_date = EXCLUDED.write_date
+            ''', (bridge.id, partner_id, model, res_id, version, payload, self.env.uid, self.env.uid))
+
+    @api.model
+    def _reset_state(self, bridge, partner_id, model, res_id):
+        ''' Forgets the last pushed version, so the next push is a full one'''
+        _states.pop((self.env.cr.dbname, bridge.id, partner_id, model, res_id))
+        if bridge.delta_persistent:
+            self.env.cr.execute('''
+                DELETE FROM firebase_push_state
+                 WHERE bridge_id = %s AND partner_id = %s AND model = %s AND res_id = %s
+            ''', (bridge.id, partner_id, model, res_id))
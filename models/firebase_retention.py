@@ -0,0 +1,103 @@
+import logging
+import time
+from datetime import timedelta
+
+from dateutil.relativedelta import relativedelta
+
+from odoo import _, api, models, fields
+
+logger = logging.getLogger(__name__)
+
+
+class FirebaseRetention(models.Model):
+    ''' How long sent messages of a type are kept'''
+    _name = 'firebase.retention'
+    _description = 'Firebase message retention policy'
+    _rec_name = 'type'
+    _order = 'type'
+
+    type = fields.Char(_('Message type'), help=_('Leave empty for the types without a policy of their own'))
+    hours = fields.Integer(_('Keep (hours)'), required=True, default=24 * 7)
+    archive = fields.Boolean(_('Archive'), default=False,
+        help=_('Move purged messages to monthly firebase_message_archive_YYYYMM tables instead of deleting them'))
+    active = fields.Boolean(default=True)
+
+    _sql_constraints = [
+        ('type_uniq', 'unique(type)', 'There can be only one retention policy per message type'),
+    ]
+
+    def _get_condition(self):
+        ''' SQL condition and params selecting the sent messages of the policy
+            older than its retention'''
+        cutoff = fields.Datetime.now() - timedelta(hours=self.hours)
+        if self.type:
+            return 'type = %s AND sent < %s', [self.type, cutoff]
+        others = self.search([('type', '!=', False)]).mapped('type')
+        # NOT IN is never true for NULL
+        return '(type IS NULL OR type NOT IN %s) AND sent < %s', [tuple(others) or ('',), cutoff]
+
+    def _get_columns(self, table):
+        ''' Column names and SQL types of table, in order'''
+        self.env.cr.execute('''
+            SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+             WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+             ORDER BY attnum
+        ''', (table,))
+        return self.env.cr.fetchall()
+
+    def _prepare_archive(self, table):
+        ''' Creates the archive table, or adds to it the columns added to
+            firebase_message since it was created. Returns the columns to 
+            copy'''
+        cr = self.env.cr
+        cr.execute('CREATE TABLE IF NOT EXISTS %s (LIKE firebase_message)' % table)
+        columns = self._get_columns('firebase_message')
+        archived = {name for name, _type in self._get_columns(table)}
+        for name, column_type in columns:
+            if name not in archived:
+                cr.execute('ALTER TABLE %s ADD COLUMN "%s" %s' % (table, name, column_type))
+        return [name for name, _type in columns]
+
+    def _purge_batch(self, limit):
+        ''' Deletes (or archives) up to limit messages. Returns how many'''
+        cr = self.env.cr
+        condition, params = self._get_condition()
+        if self.archive:
+            # One month per batch, so rows go to a single archive table
+            cr.execute("SELECT date_trunc('month', min(sent)) FROM firebase_message WHERE " + condition, params)
+            month = cr.fetchone()[0]
+            if not month:
+                return 0
+            table = 'firebase_message_archive_%s' % month.strftime('%Y%m')
+            columns = ', '.join('"%s"' % name for name in self._prepare_archive(table))
+            condition += ' AND sent < %s'
+            params = params + [month + relativedelta(months=1)]
+            prefix, suffix = 'WITH moved AS (', ' RETURNING %s) INSERT INTO %s (%s) SELECT %s FROM moved' % (columns, table, columns, columns)
+        else:
+            prefix, suffix = '', ''
+        cr.execute(prefix + '''
+            DELETE FROM firebase_message WHERE id IN (
+                SELECT id FROM firebase_message
+                 WHERE ''' + condition + '''
+                 ORDER BY sent LIMIT %s
+                   FOR UPDATE SKIP LOCKED)''' + suffix, params + [limit])
+        return cr.rowcount
+
+    @api.model
+    def _cron_purge(self, batch=5000, max_time=60):
+        ''' Applies the retention policies in batches of batch messages, 
+            committing after each one, for at most max_time seconds'''
+        deadline = time.monotonic() + max_time
+        self.env['firebase.message'].flush()
+        for policy in self.search([]):
+            purged = 0
+            while time.monotonic() < deadline:
+                count = policy._purge_batch(batch)
+                self.env.cr.commit()
+                purged += count
+                if count < batch:
+                    break
+            logger.info('Firebase retention %s: %s messages purged', policy.type or 'default', purged)
+            if time.monotonic() >= deadline:
+                logger.info('Firebase retention: time limit reached, resuming on next run')
+                break
@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import functools
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from odoo import sql_db
+from odoo.tools import config
+
+from .firebase_metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+# PostgreSQL channel notified by firebase.message on every commit that queues
+# outbound messages. The runner LISTENs on it to wake up bridges immediately.
+NOTIFY_CHANNEL = 'firebase_message'
+# Safety net: check pending messages at least this often (seconds) even if no
+# notification arrived (e.g. messages inserted by raw SQL).
+POLL_TIMEOUT = 60
+# Seconds between attempts to LISTEN again after the connection was lost
+LISTEN_RETRY = 5
+
+
+class KeyedDispatcher(object):
+    ''' Runs jobs in a thread pool. Jobs sharing a key run one at a time, in
+        submission order, while jobs of different keys run in parallel.
+        At most max_pending jobs are accepted. Must be used from the loop'''
+
+    def __init__(self, loop, executor, max_pending, metrics=None):
+        self.loop = loop
+        self.executor = executor
+        self.max_pending = max_pending
+        self.metrics = metrics
+        self.pending = 0
+        self.queues = {}  # key -> deque of jobs, present while key is busy
+
+    def submit(self, key, func, *args):
+        ''' Queues func(*args). Returns False if the queue is full'''
+        if self.pending >= self.max_pending:
+            return False
+        self.pending += 1
+        job = (func, args, time.monotonic())
+        queue = self.queues.get(key)
+        if queue is not None:
+            queue.append(job)
+        else:
+            self.queues[key] = deque([job])
+            self.loop.create_task(self._drain(key))
+        return True
+
+    async def _drain(self, key):
+        queue = self.queues[key]
+        while queue:
+            func, args, queued = queue[0]
+            if self.metrics:
+                self.metrics.observe('firebase_stage_seconds', time.monotonic() - queued, stage='queue')
+            try:
+                await self.loop.run_in_executor(self.executor, functools.partial(func, *args))
+            except Exception:
+                logger.exception('Firebase dispatcher job failed (%s)', key)
+            finally:
+                queue.popleft()
+                self.pending -= 1
+        del self.queues[key]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class TTLCache(object):
+    ''' Thread-safe LRU cache of at most maxsize entries, expiring after 
+        ttl seconds'''
+
+    def __init__(self, ttl, maxsize=1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # key -> (expiry, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                return entry[1]
+            self.entries.pop(key, None)
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self.entries.pop(key, None)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return default
+
+    def invalidate(self, predicate=None):
+        ''' Drops entries whose key matches predicate, or all of them'''
+        with self._lock:
+            if predicate is None:
+                self.entries.clear()
+            else:
+                for key in [k for k in self.entries if predicate(k)]:
+                    del self.entries[key]
+
+
+class SessionCache(object):
+    ''' Per-bridge (device, key) -> (session_id, user_id, partner_id) cache 
+        with TTL, holding at most maxsize sessions. Also coalesces session 
+        heartbeats until they are flushed. Thread-safe'''
+
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl = ttl
+        self.entries = TTLCache(ttl, maxsize)  # (device, key) -> info
+        self.heartbeats = {}  # session_id -> (partner_id, last)
+        self._lock = threading.Lock()
+
+    def get(self, device, key):
+        return self.entries.get((device, key))
+
+    def put(self, device, key, info):
+        self.entries.put((device, key), info)
+
+    def invalidate(self, devices=None):
+        ''' Drops cached sessions of devices (a set), or all of them. One 
+            pass over the cache, however many devices'''
+        self.entries.invalidate(None if devices is None else lambda k: k[0] in devices)
+
+    def touch(self, session_id, partner_id, last):
+        with self._lock:
+            self.heartbeats[session_id] = (partner_id, last)
+
+    def pop_heartbeats(self):
+        with self._lock:
+            heartbeats, self.heartbeats = self.heartbeats, {}
+        return heartbeats
+
+
+class PoolMember(object):
+    ''' One XMPP stream of a bridge connection pool'''
+
+    def __init__(self, index, xmpp):
+        self.index = index
+        self.xmpp = xmpp
+        self.connected = False
+        self.draining = False  # FCM is closing it: no new sends
+        self.retired = False  # replaced, removed from the pool once closed
+        self.supervised = False  # a reconnect task is running
+        self.attempts = 0
+        self.inflight = {}  # ref -> (key, device, sent time), waiting for ACK
+        self.expiry = None  # asyncio.TimerHandle of the next ACK timeout check
+        self.up = asyncio.Event()  # set while connected
+
+    @property
+    def healthy(self):
+        return self.connected and not self.draining
+
+    async def wait_connected(self, timeout):
+        ''' Waits up to timeout seconds for the stream to connect. 
+            Returns whether it is connected'''
+        try:
+            await asyncio.wait_for(self.up.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.connected
+
+
+class BridgeConnection(object):
+    ''' Runtime state of a bridge hosted by the runner. FCM limits the
+        unacknowledged messages of each XMPP stream, so a bridge may open a
+        pool of them and spread sends by least in flight'''
+
+    def __init__(self, runner, dbname, bridge_id):
+        self.runner = runner
+        self.dbname = dbname
+        self.bridge_id = bridge_id
+        self.members = []  # PoolMember
+        self.params = {}  # settings the pool members are created with
+        self.dispatcher = None
+        self.sessions = None
+        self.cursors = TTLCache(300, 256)  # paginated RPC results
+        self.reads = None  # TTLCache of read RPC results, if enabled
+        self.address = None
+        self.use_ssl = True
+        self.stopped = False
+        self.closed = False
+        self.metrics = get_metrics(dbname, bridge_id)
+        self.wakeup = None  # asyncio.Event, created on the loop
+        self.next_due = None  # time.monotonic() of the next deferred message
+        self.polling = 0  # if set, seconds between message loop runs, ignoring wake-ups (baseline benchmarks)
+        self.max_inflight = 100  # FCM limit of unacknowledged messages per stream
+        self.ack_timeout = 60  # seconds before a message in flight is given up
+        self.slot_freed = None  # asyncio.Event, created on the loop
+        self.acks = deque()  # (key, device, error) waiting to be stored
+        self.state_sync = None  # future of the job storing the pool state
+        self.state_dirty = False  # pool state changed since that job started
+        self._refs = itertools.count()
+
+    @property
+    def xmpp(self):
+        ''' Least busy healthy stream, for one-off sends'''
+        member = self.pick() or (self.members and self.members[0])
+        return member and member.xmpp
+
+    @property
+    def inflight(self):
+        return sum(len(m.inflight) for m in self.members)
+
+    def healthy_count(self):
+        return sum(1 for m in self.members if m.healthy)
+
+    def pool_size(self):
+        ''' Members in the pool, not counting the ones being replaced'''
+        return sum(1 for m in self.members if not m.retired)
+
+    def pick(self):
+        ''' Healthy member with the fewest messages in flight and a free
+            slot, or None'''
+        candidates = [m for m in self.members if m.healthy and len(m.inflight) < self.max_inflight]
+        return min(candidates, key=lambda m: len(m.inflight), default=None)
+
+    def wake(self):
+        ''' Wakes up the message loop. Must be called from the event loop'''
+        if self.wakeup:
+            self.wakeup.set()
+
+    def stop(self):
+        ''' Thread-safe stop request'''
+        self.stopped = True
+        self.runner.loop.call_soon_threadsafe(self.wake)
+
+    def close(self):
+        ''' Stops the connection for good: disconnects every stream and
+            shuts the dispatcher down. Runs on the loop, safe to call twice'''
+        self.stopped = True
+        if self.closed:
+            return
+        self.closed = True
+        for member in list(self.members):
+            if member.expiry:
+                member.expiry.cancel()
+                member.expiry = None
+            try:
+                member.xmpp.disconnect(0.0)
+            except Exception:
+                logger.exception('Firebase Bridge %s: stream %s disconnection failed', self.bridge_id, member.index)
+        if self.dispatcher:
+            self.dispatcher.shutdown()
+
+    async def wait(self, timeout):
+        ''' Waits until a message is queued or timeout expires'''
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.wakeup.clear()
+
+    async def _acquire(self, timeout):
+        ''' Waits up to timeout seconds for a member with a free slot.
+            Gives up at once if no member is up'''
+        if self.slot_freed is None:
+            self.slot_freed = asyncio.Event()
+        deadline = time.monotonic() + timeout
+        member = self.pick()
+        while member is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.healthy_count():
+                return None
+            self.slot_freed.clear()
+            try:
+                await asyncio.wait_for(self.slot_freed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            member = self.pick()
+        return member
+
+    async def send_batch(self, payloads, timeout=30):
+        ''' Sends (key, devices, data, options) payloads on the pool streams.
+            Each stream has at most max_inflight messages waiting for their
+            ACK: beyond that, sending waits up to timeout seconds for a free 
+            slot on any of them, once per batch: sending stops at the first 
+            wait timing out, or while the whole pool is down.
+            Returns the keys that could not be handed off'''
+        failed = []
+        for i, (key, devices, data, options) in enumerate(payloads):
+            for device in devices:
+                member = await self._acquire(timeout)
+                if member is None:
+                    deferred = [p[0] for p in payloads[i:]]
+                    logger.warning('Firebase Bridge %s: no connection slot available, deferring %s messages', self.bridge_id, len(deferred))
+                    return failed + deferred
+                ref = next(self._refs)
+                try:
+                    member.xmpp.send_gcm(device, data, options=options, cb=functools.partial(self._on_ack, member, ref))
+                except Exception:
+                    logger.exception('Firebase Bridge %s: error sending %s', self.bridge_id, key)
+                    failed.append(key)
+                    break
+                member.inflight[ref] = (key, device, time.monotonic())
+                self._schedule_expiry(member)
+        return failed
+
+    def _schedule_expiry(self, member, delay=None):
+        ''' Arms the ACK timeout check of member, unless already armed. 
+            Runs apart from the message loop, which may be waiting for the
+            very slots it frees'''
+        if member.expiry is None:
+            member.expiry = self.runner.loop.call_later(
+                self.ack_timeout if delay is None else delay, self._expire_member, member)
+
+    def _expire_member(self, member):
+        member.expiry = None
+        self.expire_inflight(self.ack_timeout, members=[member])
+        if member.inflight:
+            oldest = min(sent for _key, _device, sent in member.inflight.values())
+            self._schedule_expiry(member, max(0, oldest + self.ack_timeout - time.monotonic()))
+
+    def _release(self):
+        if self.slot_freed:
+            self.slot_freed.set()
+
+    def _on_ack(self, member, ref, data):
+        ''' xmppgcm ACK/NACK callback of the message sent as ref'''
+        entry = member.inflight.pop(ref, None)
+        if entry is None:
+            return
+        self._release()
+        data = getattr(data, 'data', data) or {}
+        error = (data.get('error') or 'NACK') if data.get('message_type') == 'nack' else None
+        self.acks.append((entry[0], entry[1], error))
+        self.metrics.inc('firebase_acks_total', result='nack' if error else 'ack')
+        if error:
+            self.metrics.inc('firebase_nacks_total', error=error)
+        self.wake()
+
+    def expire_inflight(self, timeout=None, error='ACK_TIMEOUT', members=None):
+        ''' Gives up waiting for the ACK of messages sent more than timeout
+            seconds ago, or all of them, and reports them with error'''
+        limit = time.monotonic() - timeout if timeout is not None else None
+        for member in members or self.members:
+            for ref, (key, device, sent) in list(member.inflight.items()):
+                if limit is None or sent < limit:
+                    del member.inflight[ref]
+                    self.acks.append((key, device, error))
+                    self._release()
+        if self.acks:
+            self.wake()
+
+    def pop_acks(self):
+        ''' Thread-safe: returns the received ACKs/NACKs not stored yet'''
+        acks = []
+        while self.acks:
+            acks.append(self.acks.popleft())
+        return acks
+
+
+class BridgeRunner(object):
+    ''' Hosts every bridge connection of the process as a task of one shared
+        asyncio event loop, run by a single supervisor thread.
+        Database work is offloaded to a bounded thread pool, so a slow RPC
+        never blocks the XMPP streams.'''
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.executor = None
+        self.connections = {}  # (dbname, bridge_id) -> BridgeConnection
+        self.listeners = {}  # dbname -> (LISTEN cursor, its socket)
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        with self._lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.loop = asyncio.new_event_loop()
+            self.executor = ThreadPoolExecutor(
+                max_workers=int(config.get('firebase_db_workers', 4)),
+                thread_name_prefix='firebase-db')
+            self.thread = threading.Thread(name='firebase-runner', target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        logger.info('Firebase runner started')
+        self.loop.run_forever()
+
+    def get(self, dbname, bridge_id):
+        return self.connections.get((dbname, bridge_id))
+
+    def start(self, dbname, bridge_id, func, *args, on_exit=None):
+        ''' Registers a connection for the bridge and schedules the coroutine
+            func(connection, *args) on the loop. on_exit(connection) is run
+            in the DB executor once func returned or crashed, and the
+            connection closed. Returns the connection'''
+        self.ensure_started()
+        with self._lock:
+            conn = self.connections.get((dbname, bridge_id))
+            if conn and not conn.stopped:
+                logger.warning('Firebase Bridge %s already running', bridge_id)
+                return conn
+            conn = BridgeConnection(self, dbname, bridge_id)
+            self.connections[(dbname, bridge_id)] = conn
+        asyncio.run_coroutine_threadsafe(self._serve(conn, func, *args, on_exit=on_exit), self.loop)
+        return conn
+
+    def stop(self, dbname, bridge_id):
+        conn = self.get(dbname, bridge_id)
+        if conn:
+            conn.stop()
+
+    async def _serve(self, conn, func, *args, on_exit=None):
+        conn.wakeup = asyncio.Event()
+        try:
+            self._listen(conn.dbname)
+            await func(conn, *args)
+        except Exception:
+            logger.exception('Firebase Bridge %s crashed', conn.bridge_id)
+        finally:
+            # Never leave streams or workers running without their task
+            conn.close()
+            with self._lock:
+                if self.connections.get((conn.dbname, conn.bridge_id)) is conn:
+                    del self.connections[(conn.dbname, conn.bridge_id)]
+                last = not any(db == conn.dbname for db, _bid in self.connections)
+            if last:
+                self._unlisten(conn.dbname)
+            if on_exit:
+                try:
+                    await self.run_db(on_exit, conn)
+                except Exception:
+                    logger.exception('Firebase Bridge %s exit handler failed', conn.bridge_id)
+
+    def run_db(self, func, *args, **kwargs):
+        ''' Runs func in the DB executor. Returns an awaitable future'''
+        return self.loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def spawn_db(self, func, *args, **kwargs):
+        ''' Fire-and-forget version of run_db, logging errors'''
+        future = self.run_db(func, *args, **kwargs)
+        future.add_done_callback(self._log_error)
+        return future
+
+    def call(self, coro, timeout=None):
+        ''' Runs coro on the loop from another thread and waits for its result'''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def _log_error(self, future):
+        if not future.cancelled() and future.exception():
+            logger.error('Firebase runner task failed', exc_info=future.exception())
+
+    def _listen(self, dbname):
+        ''' Opens a dedicated cursor LISTENing on NOTIFY_CHANNEL for dbname,
+            polled by the loop'''
+        if dbname in self.listeners:
+            return
+        cr = sql_db.db_connect(dbname).cursor()
+        cr.execute('LISTEN %s' % NOTIFY_CHANNEL)
+        cr.commit()
+        fd = cr._cnx.fileno()
+        self.listeners[dbname] = (cr, fd)
+        self.loop.add_reader(fd, self._on_notify, dbname, cr._cnx)
+
+    def _unlisten(self, dbname):
+        cr, fd = self.listeners.pop(dbname, (None, None))
+        if cr:
+            self.loop.remove_reader(fd)
+            try:
+                cr.close()
+            except Exception:
+                logger.warning('Firebase runner: could not close the LISTEN cursor of %s', dbname, exc_info=True)
+
+    def _relisten(self, dbname):
+        ''' LISTENs again after the connection was lost, while bridges of 
+            dbname are running, and wakes them up: notifications may have
+            been missed meanwhile'''
+        conns = [c for (db, _bid), c in self.connections.items() if db == dbname]
+        if not conns or dbname in self.listeners:
+            return
+        try:
+            self._listen(dbname)
+        except Exception:
+            logger.warning('Firebase runner: LISTEN on %s failed, retrying in %ss', dbname, LISTEN_RETRY, exc_info=True)
+            self.loop.call_later(LISTEN_RETRY, self._relisten, dbname)
+            return
+        logger.info('Firebase runner: listening on %s again', dbname)
+        for conn in conns:
+            conn.wake()
+
+    def _on_notify(self, dbname, cnx):
+        ''' Reader callback for a LISTEN connection. Payloads are bridge ids'''
+        try:
+            cnx.poll()
+        except Exception:
+            # Bridges fall back to polling until the connection is back
+            logger.warning('Firebase runner: LISTEN connection of %s lost', dbname, exc_info=True)
+            self._unlisten(dbname)
+            self.loop.call_later(LISTEN_RETRY, self._relisten, dbname)
+            return
+        for notify in cnx.notifies:
+            conn = self.get(dbname, int(notify.payload or 0))
+            if conn:
+                conn.wake()
+        cnx.notifies.clear()
+
+
+runner = BridgeRunner()
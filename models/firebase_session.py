@@ -1,5 +1,11 @@
+from datetime import timedelta
 from odoo import _, api, models, fields
+from odoo.exceptions import UserError
+from odoo.osv import expression
 import logging
+
+from .firebase_bridge import PING
+from .firebase_runner import runner
 _logger = logging.getLogger(__name__)
 
 class FirebaseSession(models.Model):
@@ -19,21 +25,82 @@ class FirebaseSession(models.Model):
     partner_id = fields.Many2one('res.partner',string=_('Contact'),)
     key = fields.Char(string=_('Key'))
     last = fields.Datetime(_('Last visible'))
+    next_ping = fields.Datetime(_('Next ping'), help=_('Idle sessions are not pinged before this time'))
     closed = fields.Boolean(_('Closed'))
-    is_active = fields.Boolean(_('Active'), compute='_compute_active', store=True)
+    is_active = fields.Boolean(_('Active'), compute='_compute_active', search='_search_is_active')
+    active = fields.Boolean(_('Live'), default=True, help=_('Closed and expired sessions are archived by check_sessions'))
+    
+    def init(self):
+        # Live session lookups: by bridge, partner and last visible time
+        self.env.cr.execute('''
+            CREATE INDEX IF NOT EXISTS firebase_session_live_idx
+                ON firebase_session (bridge_id, partner_id, last)
+             WHERE active = true
+        ''')
+        # Ping scheduler, see firebase.bridge._claim_due_sessions
+        self.env.cr.execute('''
+            CREATE INDEX IF NOT EXISTS firebase_session_ping_idx
+                ON firebase_session (bridge_id, next_ping)
+             WHERE active = true
+        ''')
     
-    @api.depends('last', 'closed')
+    @api.depends('last', 'closed', 'bridge_id.session_timeout')
     def _compute_active(self):
         for record in self:
-            record.is_active = not record.closed and record.last and (fields.Datetime.now() - record.last).total_seconds() <  record.bridge_id.session_timeout
+            record.is_active = bool(not record.closed and record.last and (fields.Datetime.now() - record.last).total_seconds() <  record.bridge_id.session_timeout)
+    
+    def _search_is_active(self, operator, value):
+        if operator not in ('=', '!=') or not isinstance(value, bool):
+            raise UserError(_('Operation not supported'))
+        domain = self._get_active_domain()
+        if (operator == '=') == value:
+            return domain
+        return ['!'] + domain
+    
+    @api.model
+    def _get_active_domain(self, bridges=None):
+        ''' Domain of open sessions seen within their bridge's timeout'''
+        now = fields.Datetime.now()
+        bridges = bridges or self.env['firebase.bridge'].sudo().search([])
+        return expression.AND([
+            [('closed', '=', False)],
+            expression.OR([
+                [('bridge_id', '=', b.id), ('last', '>=', now - timedelta(seconds=b.session_timeout))]
+                for b in bridges
+            ]),
+        ])
             
+    def write(self, vals):
+        if {'device', 'key', 'closed', 'user_id', 'active'} & set(vals):
+            self._invalidate_session_cache()
+        return super(FirebaseSession, self).write(vals)
+    
+    def unlink(self):
+        self._invalidate_session_cache()
+        return super(FirebaseSession, self).unlink()
+    
+    def _invalidate_session_cache(self):
+        ''' Drops these sessions from their bridge's authentication cache'''
+        for bridge in self.mapped('bridge_id'):
+            conn = bridge.get_connection()
+            if conn and conn.sessions:
+                conn.sessions.invalidate(set(self.filtered(lambda s: s.bridge_id == bridge).mapped('device')))
+    
     def set_last(self,last):
         self.last = last
         self.partner_id.firebase_last = last
         
     def ping(self):
+        ''' Pings the sessions: straight on the XMPP connection if the bridge
+            runs in this process, through ping messages otherwise'''
+        for bridge in self.mapped('bridge_id'):
+            conn = bridge.get_connection()
+            if conn:
+                sessions = self.filtered(lambda s: s.bridge_id == bridge)
+                failed = runner.call(conn.send_batch([(s.id, [s.device], PING, {}) for s in sessions]))
+                bridge._schedule_pings([s.id for s in sessions if s.id not in failed])
         for record in self:
-            if record.bridge_id.connected:
+            if record.bridge_id.connected and not record.bridge_id.get_connection():
                 msg = {
                     'bridge_id': record.bridge_id.id,
                     'device': record.device,
@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+from . import test_encoder, test_cache, test_dispatcher, test_merge_push
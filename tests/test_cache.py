@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from unittest.mock import patch
+
+from odoo.tests import BaseCase
+
+from ..models import firebase_runner
+from ..models.firebase_runner import SessionCache, TTLCache
+
+
+class TestTTLCache(BaseCase):
+
+    def setUp(self):
+        super(TestTTLCache, self).setUp()
+        patcher = patch.object(firebase_runner, 'time')
+        self.clock = patcher.start()
+        self.clock.monotonic.return_value = 1000.0
+        self.addCleanup(patcher.stop)
+
+    def test_expiry(self):
+        cache = TTLCache(10)
+        cache.put('a', 1)
+        self.clock.monotonic.return_value = 1009.0
+        self.assertEqual(cache.get('a'), 1)
+        self.clock.monotonic.return_value = 1010.0
+        self.assertIsNone(cache.get('a'))
+        self.assertNotIn('a', cache.entries)
+
+    def test_put_refreshes_expiry(self):
+        cache = TTLCache(10)
+        cache.put('a', 1)
+        self.clock.monotonic.return_value = 1008.0
+        cache.put('a', 2)
+        self.clock.monotonic.return_value = 1015.0
+        self.assertEqual(cache.get('a'), 2)
+
+    def test_lru(self):
+        cache = TTLCache(10, maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')  # b is now the least recently used
+        cache.put('c', 3)
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+        self.assertIsNone(cache.get('b'))
+
+    def test_pop(self):
+        cache = TTLCache(10)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertIsNone(cache.pop('a'))
+        self.clock.monotonic.return_value = 1020.0
+        self.assertEqual(cache.pop('b', 'gone'), 'gone')
+        self.assertFalse(cache.entries)
+
+    def test_invalidate(self):
+        cache = TTLCache(10)
+        for key in [(1, 'a'), (1, 'b'), (2, 'a')]:
+            cache.put(key, True)
+        cache.invalidate(lambda k: k[0] == 1)
+        self.assertEqual(list(cache.entries), [(2, 'a')])
+        cache.invalidate()
+        self.assertFalse(cache.entries)
+
+    def test_session_cache(self):
+        sessions = SessionCache(10, maxsize=3)
+        for device in 'abcd':
+            sessions.put(device, 'key', (1, 2, 3))
+        self.assertIsNone(sessions.get('a', 'key'))
+        self.assertEqual(sessions.get('b', 'key'), (1, 2, 3))
+        self.assertIsNone(sessions.get('b', 'other'))
+        sessions.invalidate({'b', 'c'})
+        self.assertEqual([sessions.get(d, 'key') for d in 'bcd'], [None, None, (1, 2, 3)])
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from odoo.tests import BaseCase
+
+from ..models import firebase_runner
+from ..models.firebase_runner import KeyedDispatcher
+
+
+class TestKeyedDispatcher(BaseCase):
+
+    def setUp(self):
+        super(TestKeyedDispatcher, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(self.executor.shutdown)
+
+    def _run(self, dispatcher):
+        async def drained():
+            while dispatcher.queues:
+                await asyncio.sleep(0.01)
+        self.loop.run_until_complete(asyncio.wait_for(drained(), 10))
+
+    def test_order_per_key(self):
+        ''' Jobs of a key run one at a time in order, keys in parallel'''
+        dispatcher = KeyedDispatcher(self.loop, self.executor, 1000)
+        done, running, lock = [], {}, threading.Lock()
+        overlaps = []
+
+        def job(key, i):
+            with lock:
+                if running.get(key):
+                    overlaps.append(key)
+                running[key] = True
+            time.sleep(0.001 * (i % 3))
+            with lock:
+                running[key] = False
+                done.append((key, i))
+
+        for i in range(30):
+            for key in 'abc':
+                self.assertTrue(dispatcher.submit(key, job, key, i))
+        self._run(dispatcher)
+        self.assertFalse(overlaps)
+        for key in 'abc':
+            self.assertEqual([i for k, i in done if k == key], list(range(30)))
+        self.assertEqual(dispatcher.pending, 0)
+
+    def test_failing_job(self):
+        ''' A failing job does not stop the next ones of its key'''
+        dispatcher = KeyedDispatcher(self.loop, self.executor, 10)
+        done = []
+
+        def fail():
+            raise ValueError('boom')
+        dispatcher.submit('a', fail)
+        dispatcher.submit('a', done.append, 1)
+        with self.assertLogs(firebase_runner.logger.name, 'ERROR'):
+            self._run(dispatcher)
+        self.assertEqual(done, [1])
+        self.assertEqual(dispatcher.pending, 0)
+
+    def test_max_pending(self):
+        dispatcher = KeyedDispatcher(self.loop, self.executor, 2)
+        self.assertTrue(dispatcher.submit('a', time.sleep, 0))
+        self.assertTrue(dispatcher.submit('b', time.sleep, 0))
+        self.assertFalse(dispatcher.submit('c', time.sleep, 0))
+        self._run(dispatcher)
+        self.assertTrue(dispatcher.submit('c', time.sleep, 0))
+        self._run(dispatcher)
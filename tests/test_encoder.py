@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import base64
+import json
+import random
+import zlib
+from unittest.mock import patch
+
+from odoo.tests import BaseCase
+
+from ..models import firebase_encoder
+from ..models.firebase_encoder import compress, encode_chunks, encode_error, size, ZLIB_BASE64
+
+
+def reassemble(chunks):
+    ''' Client side: records of a response, from its chunks in any order'''
+    records, fragment = [], ''
+    parsed = sorted((json.loads(c) for c in chunks), key=lambda c: c['seq'])
+    for chunk in parsed:
+        if 'fragment' in chunk:
+            fragment += chunk['fragment']
+            if not chunk['more']:
+                records.append(json.loads(fragment))
+                fragment = ''
+        else:
+            records.extend(chunk['records'])
+    return records, parsed
+
+
+class TestEncoder(BaseCase):
+
+    def test_size_counts_bytes(self):
+        self.assertEqual(size('abc'), 3)
+        self.assertEqual(size('é漢'), 5)
+
+    def test_compress(self):
+        self.assertEqual(compress('short', 100), ('short', None))
+        self.assertEqual(compress('x' * 1000, 0), ('x' * 1000, None))
+        text = json.dumps([{'name': 'Ñandú %s' % (i % 3)} for i in range(200)], ensure_ascii=False)
+        packed, encoding = compress(text, 100)
+        self.assertEqual(encoding, ZLIB_BASE64)
+        self.assertEqual(zlib.decompress(base64.b64decode(packed)).decode(), text)
+        # Random data does not shrink: left as is
+        rng = random.Random(1)
+        noise = base64.b64encode(bytes(rng.getrandbits(8) for _i in range(300))).decode()
+        self.assertEqual(compress(noise, 10), (noise, None))
+
+    def test_empty_response(self):
+        chunks = encode_chunks([], 'c1')
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(json.loads(chunks[0]), {'id': 'c1', 'seq': 0, 'total': 1, 'cursor': None, 'records': []})
+
+    def test_error(self):
+        chunk = json.loads(encode_error('c1', 'cursor_expired'))
+        self.assertEqual(chunk['error'], 'cursor_expired')
+        self.assertEqual((chunk['id'], chunk['seq'], chunk['total'], chunk['cursor'], chunk['records']), ('c1', 0, 1, None, []))
+
+    def _check_round_trip(self, rng, max_size):
+        alphabet = 'abc "\\\n\té漢😀'
+        records = [{
+            'id': i,
+            'name': ''.join(rng.choice(alphabet) for _n in range(rng.choice([0, 5, 50, 500, 5000]))),
+        } for i in range(rng.randint(0, 30))]
+        correlation_id = rng.choice(['c', 'ñ-%s' % rng.random(), 42])
+        cursor = rng.choice([None, 'abcdef'])
+        chunks = encode_chunks(records, correlation_id, cursor, max_size)
+        for chunk in chunks:
+            self.assertLessEqual(size(chunk), max_size)
+        got, parsed = reassemble(chunks)
+        self.assertEqual(got, records)
+        self.assertEqual([c['seq'] for c in parsed], list(range(len(chunks))))
+        for chunk in parsed:
+            self.assertEqual((chunk['id'], chunk['total'], chunk['cursor']), (correlation_id, len(chunks), cursor))
+
+    def test_round_trip(self):
+        ''' Chunks fit in max_size bytes and reassemble to the records, with
+            escaping and multi-byte characters, for both encoders'''
+        rng = random.Random(42)
+        for encoder in ('json', 'orjson'):
+            if encoder not in firebase_encoder.ENCODERS:
+                continue
+            with patch.object(firebase_encoder, 'dumps', firebase_encoder.ENCODERS[encoder]):
+                for _case in range(150):
+                    with self.subTest(encoder=encoder, case=_case):
+                        self._check_round_trip(rng, rng.choice([300, 1000, 3500]))
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import TransactionCase
+
+
+class TestMergePush(TransactionCase):
+
+    def setUp(self):
+        super(TestMergePush, self).setUp()
+        self.merge = self.env['firebase.bridge']._merge_push
+
+    def test_full_push_replaces(self):
+        self.assertEqual(
+            self.merge('delta', {'id': 1, 'version': 2, 'base': 1, 'values': {'a': 1}}, 'object', {'id': 1, 'a': 2, '__version': 1}),
+            ('object', {'id': 1, 'a': 2, '__version': 1}))
+
+    def test_delta_on_delta(self):
+        ''' Values are merged, newer ones win, and the pending base is kept
+            so that devices at that version can apply it'''
+        old = {'id': 1, 'version': 2, 'base': 1, 'values': {'a': 1, 'b': 1}}
+        new = {'id': 1, 'version': 3, 'base': 2, 'values': {'b': 2, 'c': 2}}
+        self.assertEqual(self.merge('delta', old, 'delta', new),
+                         ('delta', {'id': 1, 'version': 3, 'base': 1, 'values': {'a': 1, 'b': 2, 'c': 2}}))
+
+    def test_delta_on_object(self):
+        old = {'id': 1, 'a': 1, 'b': 1, '__version': 1}
+        new = {'id': 1, 'version': 2, 'base': 1, 'values': {'b': 2}}
+        self.assertEqual(self.merge('object', old, 'delta', new),
+                         ('object', {'id': 1, 'a': 1, 'b': 2, '__version': 2}))